@@ -1,7 +1,11 @@
-import http.client
-import json
+import os
+import sys
 import csv
 
+# Shared Sysdig API client in the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from sysdig_api_client import SysdigApiClient
+
 # the api endpoint
 apiEndPoint = "us2.app.sysdig.com"
 
@@ -11,8 +15,8 @@ customerApiKey = "xxxxxxxxxxxxx"
 # the result filters to use
 filters = ["Up+to+Date", "Almost+Out+of+Date", "Out+of+Date"]
 
-# startup an http client
-conn = http.client.HTTPSConnection(apiEndPoint)
+# startup an api client
+api_client = SysdigApiClient(apiEndPoint, customerApiKey)
 
 # initialize the csv output file
 csvFileName = 'agent-data.csv'
@@ -20,9 +24,6 @@ csvFile = open('agent-data.csv', 'w', newline='')
 csv_writer = csv.writer(csvFile)
 csv_headers_written = False
 
-# build the auth header
-authHeader = {"Authorization": f"Bearer {customerApiKey}"}
-
 # retrieve results for each filter
 for filter in filters:
 
@@ -31,13 +32,10 @@ for filter in filters:
 
     # execute the query
     apiUrl = f"/api/cloud/v2/dataSources/agents?status={filter}"
-    conn.request("GET", url=apiUrl, headers=authHeader)
-    response = conn.getresponse()
-    print(f"http status code := {response.status}")
 
     # load the results
     print("Loading json results...")
-    jsonData = json.loads(response.read().decode("utf-8"))
+    jsonData = api_client.get_json(apiUrl)
     # DEBUG print(json.dumps(jsonData, indent=2))
     # DEBUG raise SystemExit()
 
@@ -0,0 +1,135 @@
+"""
+  This python script will measure the memory the runtime report holds for
+  the runtime workload scan results list.
+
+  The synthetic fleet of the mock server is listed in pages of 1000 that are
+  json decoded like the API responses. The memory kept by the decoded
+  results is compared with the compact WorkloadResult records the runtime
+  report keeps instead, using tracemalloc.
+
+  Example:
+
+     python3 benchmarks/memory-benchmark.py --workloads 100000 --pods_per_workload 3
+"""
+
+import argparse
+import logging
+import sys
+import os
+import gc
+import json
+import importlib.util
+import tracemalloc
+
+# Setup logger
+LOG = logging.getLogger(__name__)
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s.%(msecs)03d %(levelname)s - %(funcName)s: %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MOCK_SERVER = os.path.join(REPO_DIR, "benchmarks", "mock-sysdig-secure-api.py")
+RUNTIME_REPORT = os.path.join(REPO_DIR, "sysdig-runtime-scanner", "get-runtime-scan-workload-results.py")
+
+def _parse_args():
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--workloads",
+        required=False,
+        type=int,
+        default=100000,
+        action="store",
+        help="Number of runtime workload scan results (default: 100000)",
+    )
+    parser.add_argument(
+        "--images",
+        required=False,
+        type=int,
+        action="store",
+        help="Number of unique images (default: workloads / 20)",
+    )
+    parser.add_argument(
+        "--pods_per_workload",
+        required=False,
+        type=int,
+        default=1,
+        action="store",
+        help="Number of scan results of each workload container (default: 1)",
+    )
+    return parser.parse_args()
+
+def main():
+
+    try:
+
+        args = _parse_args()
+
+        mock_server = _load_script("mock_sysdig_secure_api", MOCK_SERVER)
+        runtime_report = _load_script("get_runtime_scan_workload_results", RUNTIME_REPORT)
+
+        fleet = mock_server.Fleet(argparse.Namespace(
+            workloads=args.workloads, images=args.images, pods_per_workload=args.pods_per_workload,
+            packages=5, accepts=0, agents=0, seed=1,
+        ))
+
+        # Fill the caches of the mock fleet so they are not measured
+        _list_scan_results(fleet, args.workloads)
+
+        LOG.info(f"Measuring {args.workloads} decoded scan results...")
+        decoded_bytes = _measure(lambda: _list_scan_results(fleet, args.workloads))
+
+        LOG.info(f"Measuring {args.workloads} compact scan results...")
+        compact_bytes = _measure(lambda: _list_scan_results(fleet, args.workloads, runtime_report.WorkloadResult))
+
+        print(f"{'representation':<16} {'mb':>10} {'bytes/result':>13}")
+        print(f"{'decoded json':<16} {decoded_bytes / 1024 / 1024:>10.1f} {decoded_bytes / args.workloads:>13.0f}")
+        print(f"{'WorkloadResult':<16} {compact_bytes / 1024 / 1024:>10.1f} {compact_bytes / args.workloads:>13.0f}")
+        print(f"{compact_bytes / decoded_bytes:0.1%} of the decoded size")
+
+    except Exception as e:
+        LOG.critical(e)
+        LOG.error(f"Memory benchmark failed.")
+        raise SystemExit(-1)
+
+def _load_script(module_name, script_file_name):
+
+    # The scripts are not importable by name since their file names have dashes
+    spec = importlib.util.spec_from_file_location(module_name, script_file_name)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def _list_scan_results(fleet, workloads, record_type=None):
+
+    scan_results = []
+
+    for cursor in range(0, workloads, 1000):
+        page = json.dumps({ "data": [ fleet.get_workload(idx) for idx in range(cursor, min(cursor + 1000, workloads)) ] })
+        data = json.loads(page)["data"]
+        if record_type != None:
+            data = [ record_type(result) for result in data ]
+        scan_results.extend(data)
+
+    return scan_results
+
+def _measure(build):
+
+    # Only the memory still held by the built list is counted
+    gc.collect()
+    tracemalloc.start()
+    baseline, _ = tracemalloc.get_traced_memory()
+    scan_results = build()
+    gc.collect()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del scan_results
+
+    return current - baseline
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,501 @@
+"""
+  This python script will run a local stand in for the Sysdig Secure API so
+  the API scripts can be load tested without a live tenant.
+
+  A synthetic fleet is generated from the passed sizes and seed, the same
+  arguments always serve the same data. Every tenth image is the latest tag
+  of the image before it, so one digest runs under two pull strings that
+  have different image accepts. Supported endpoints:
+
+     GET    /secure/vulnerability/v1beta1/runtime-results
+     GET    /secure/vulnerability/v1beta1/results/{resultId}
+     GET    /api/scanning/riskmanager/v2/definitions
+     DELETE /api/scanning/riskmanager/v2/definitions/{riskAcceptanceDefinitionID}
+     GET    /api/users/me
+     GET    /api/scanning/reporting/v2/schedules
+     GET    /api/scanning/reporting/v2/schedules/{id}/status
+     GET    /api/scanning/reporting/v2/schedules/{id}/reports/{reportId}/download
+     GET    /api/cloud/v2/dataSources/agents
+     GET    /_mock/stats
+
+  The scripts only talk https so a certificate is required, a self signed
+  one can be created with:
+
+     openssl req -x509 -newkey rsa:2048 -nodes -days 1 -subj "/CN=localhost" \
+       -addext "subjectAltName=DNS:localhost" -keyout key.pem -out cert.pem
+
+  and passed to the scripts with SSL_CERT_FILE=cert.pem.
+
+  Responses larger than 1KB are gzip compressed when the client sends
+  Accept-Encoding: gzip, use --no_gzip to turn that off.
+
+  Use --latency_ms to delay every response, --throttle_rate to answer a
+  fraction of the requests with 429 and --max_requests_per_second to answer
+  429 once the request rate is exceeded, like the real API does.
+
+  The riskmanager definitions are listed with at most 200 per page, a
+  larger limit is rejected with 400.
+
+  The runtime-results filter only applies = and != conditions on the scope
+  fields joined by and, which is enough for the partitioned listing of the
+  runtime report.
+"""
+
+import argparse
+import logging
+import sys
+import json
+import ssl
+import time
+import random
+import threading
+import gzip
+import io
+import csv
+import re
+import urllib.parse
+from functools import lru_cache
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Setup logger
+LOG = logging.getLogger(__name__)
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s.%(msecs)03d %(levelname)s - %(funcName)s: %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+
+SEVERITIES = ["Critical", "High", "Medium", "Low", "Negligible"]
+PACKAGE_TYPES = ["os", "java", "python", "javascript", "golang"]
+AGENT_STATUSES = ["Up to Date", "Almost Out of Date", "Out of Date"]
+
+class Fleet:
+    """
+    Synthetic tenant data. Workloads, scan results and accepts are built from
+    their index when requested so large fleets do not have to be held in
+    memory, only deleted accepts are tracked.
+    """
+
+    def __init__(self, args):
+        self.workloads = args.workloads
+        self.images = args.images if args.images != None else max(1, args.workloads // 20)
+        self.pods_per_workload = max(1, args.pods_per_workload)
+        self.packages = args.packages
+        self.accepts = args.accepts if args.accepts != None else args.workloads // 10
+        self.agents = args.agents if args.agents != None else max(1, args.workloads // 30)
+        self.seed = args.seed
+        self.deleted_accept_ids = set()
+        self.lock = threading.Lock()
+
+    def _get_image(self, workload_idx):
+        return (workload_idx // self.pods_per_workload) % self.images
+
+    def get_image_digest(self, image_idx):
+        # every tenth image is the latest tag of the image before it, one
+        # digest is then running under two pull strings
+        if image_idx % 10 == 9:
+            image_idx -= 1
+        return f"sha256:{image_idx:064x}"
+
+    def get_image_name(self, image_idx):
+        if image_idx % 10 == 9:
+            return f"registry.example.com/team-{(image_idx - 1) % 50}/app-{image_idx - 1}:latest"
+        return f"registry.example.com/team-{image_idx % 50}/app-{image_idx}:1.{image_idx % 10}"
+
+    def get_workload(self, pod_idx):
+        workload_idx = pod_idx // self.pods_per_workload
+        image_idx = self._get_image(pod_idx)
+        vuln_totals = self._get_vuln_totals(image_idx)
+        return {
+            "resultId": f"{image_idx:032x}",
+            "resourceId": self.get_image_digest(image_idx),
+            "mainAssetName": self.get_image_name(image_idx),
+            "sbomId": f"{image_idx:032x}",
+            "isRiskSpotlightEnabled": True,
+            "policyEvaluationsResult": "failed",
+            "scope": {
+                "asset.type": "workload",
+                "kubernetes.cluster.name": f"cluster-{workload_idx % 4}",
+                "kubernetes.namespace.name": f"namespace-{(workload_idx // 4) % 25}",
+                "kubernetes.workload.type": "deployment",
+                "kubernetes.workload.name": f"workload-{workload_idx}",
+                "kubernetes.pod.container.name": f"container-{image_idx % 3}",
+            },
+            "vulnTotalBySeverity": vuln_totals,
+            "runningVulnTotalBySeverity": { severity: count // 2 for severity, count in vuln_totals.items() },
+        }
+
+    @lru_cache(maxsize=None)
+    def _get_vuln_totals(self, image_idx):
+        vuln_totals = { severity.lower(): 0 for severity in SEVERITIES }
+        for package in self.get_result(image_idx)["result"]["packages"]:
+            for vuln in package.get("vulns", []):
+                vuln_totals[vuln["severity"]["value"].lower()] += 1
+        return vuln_totals
+
+    def get_result_image(self, result_id):
+        try:
+            image_idx = int(result_id, 16)
+        except ValueError:
+            return None
+        if image_idx >= self.images:
+            return None
+        return image_idx
+
+    @lru_cache(maxsize=1024)
+    def get_result(self, image_idx):
+        # both tags of a digest have the same packages
+        rand = random.Random(self.seed * 1000003 + int(self.get_image_digest(image_idx)[7:], 16))
+        accept_defs = [
+            { "id": f"{image_idx:08x}{idx:04x}", "status": "active" if idx % 3 else "expired", "entityType": "vulnerability" }
+            for idx in range(3)
+        ]
+        packages = []
+        for package_idx in range(self.packages):
+            package_type = PACKAGE_TYPES[rand.randrange(len(PACKAGE_TYPES))]
+            package = {
+                "type": package_type,
+                "name": f"package-{package_idx}",
+                "version": f"{rand.randrange(5)}.{rand.randrange(20)}.{rand.randrange(10)}",
+                "path": "" if package_type == "os" else f"/app/lib/package-{package_idx}",
+                "suggestedFix": f"{rand.randrange(5, 9)}.0.0",
+                "inUse": rand.random() < 0.4,
+            }
+            vulns = []
+            for vuln_idx in range(rand.choice([0, 0, 1, 2, 4])):
+                vuln = {
+                    "name": f"CVE-20{rand.randrange(15, 25)}-{rand.randrange(1000, 50000)}",
+                    "severity": { "value": SEVERITIES[min(rand.randrange(6), 4)], "sourceName": "nvd" },
+                    "cvssScore": { "value": { "version": "3.1", "score": round(rand.uniform(1, 10), 1), "vector": "AV:N/AC:L/PR:N/UI:N/S:U/C:H/I:H/A:H" }, "sourceName": "nvd" },
+                    "disclosureDate": f"2023-{rand.randrange(1, 13):02d}-{rand.randrange(1, 29):02d}",
+                    "exploitable": rand.random() < 0.2,
+                    "acceptedRisks": [{ "index": rand.randrange(3) }] if rand.random() < 0.1 else [],
+                }
+                if rand.random() < 0.7:
+                    vuln["fixedInVersion"] = package["suggestedFix"]
+                    vuln["solutionDate"] = f"2024-{rand.randrange(1, 13):02d}-{rand.randrange(1, 29):02d}"
+                vulns.append(vuln)
+            if len(vulns) > 0:
+                package["vulns"] = vulns
+            packages.append(package)
+        return {
+            "result": {
+                "metadata": {
+                    "pullString": self.get_image_name(image_idx),
+                    "imageId": self.get_image_digest(image_idx),
+                    "baseOs": "debian 12.4",
+                },
+                "packages": packages,
+                "riskAcceptanceDefinitions": accept_defs,
+                # image accepts are for one pull string, not for the other tag of its digest
+                "assetAcceptedRisks": [{ "index": 1 }] if image_idx % 97 == 0 or image_idx % 10 == 8 else [],
+            }
+        }
+
+    @lru_cache(maxsize=1024)
+    def get_result_data(self, image_idx):
+        return json.dumps(self.get_result(image_idx)).encode()
+
+    def get_accept(self, accept_idx):
+        # half of the accepts are for images that are no longer running
+        image_idx = accept_idx // 2 if accept_idx % 2 == 0 else self.images + accept_idx
+        image_name = self.get_image_name(image_idx)
+        accept = {
+            "riskAcceptanceDefinitionID": f"{accept_idx:024x}",
+            "entityType": "vulnerability",
+            "entityValue": f"CVE-2023-{10000 + accept_idx}",
+            "context": [],
+            "status": "active",
+            "reason": "RiskOwned",
+            "description": "Accepted by the benchmark fleet",
+            "expirationDate": "2030-01-01",
+            "createdAt": "2024-01-01T00:00:00Z",
+            "updatedAt": "2024-01-01T00:00:00Z",
+            "username": "benchmark@example.com",
+        }
+        context_kind = accept_idx % 6
+        if context_kind in [0, 1]:
+            accept["context"] = [{ "contextType": "imageName", "contextValue": image_name }]
+        elif context_kind == 2:
+            accept["entityType"] = "imageName"
+            accept["entityValue"] = image_name
+        elif context_kind == 3:
+            accept["context"] = [{ "contextType": "imagePrefix", "contextValue": image_name.rsplit(":", 1)[0] }]
+        elif context_kind == 4:
+            accept["context"] = [{ "contextType": "packageName", "contextValue": f"package-{accept_idx % 50}" }]
+        elif context_kind == 5:
+            accept["context"] = [
+                { "contextType": "imageSuffix", "contextValue": "/" + image_name.rsplit("/", 1)[1] },
+                { "contextType": "packageName", "contextValue": f"package-{accept_idx % 50}" },
+            ]
+        return accept
+
+    def delete_accept(self, accept_id):
+        try:
+            accept_idx = int(accept_id, 16)
+        except ValueError:
+            return False
+        with self.lock:
+            if accept_idx >= self.accepts or accept_idx in self.deleted_accept_ids:
+                return False
+            self.deleted_accept_ids.add(accept_idx)
+        return True
+
+    def get_agent(self, agent_idx):
+        return {
+            "agentId": f"{agent_idx:016x}",
+            "hostName": f"node-{agent_idx}",
+            "agentVersion": f"12.{agent_idx % 20}.0",
+            "agentStatus": AGENT_STATUSES[agent_idx % 3],
+            "agentLastSeen": "2024-01-01T00:00:00Z",
+            "clusterName": f"cluster-{agent_idx % 4}",
+            "operatingSystem": "linux",
+            "architecture": "x86_64",
+        }
+
+    @lru_cache(maxsize=4)
+    def get_report_data(self, report_id):
+        report_file = io.StringIO()
+        write = csv.writer(report_file)
+        write.writerow(["Vulnerability ID", "Severity", "Package name", "Image", "K8S cluster name", "K8S workload name"])
+        for pod_idx in range(0, self.workloads, self.pods_per_workload):
+            workload = self.get_workload(pod_idx)
+            write.writerow([f"CVE-2023-{pod_idx}", "High", "package-0", workload["mainAssetName"], workload["scope"]["kubernetes.cluster.name"], workload["scope"]["kubernetes.workload.name"]])
+        return gzip.compress(report_file.getvalue().encode())
+
+class RequestStats:
+    """Counts the requests served so the benchmarks can report them"""
+
+    def __init__(self):
+        self.requests = {}
+        self.throttled = 0
+        self.started = time.monotonic()
+        self.window_start = time.monotonic()
+        self.window_requests = 0
+        self.lock = threading.Lock()
+
+    def add(self, endpoint):
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+    def add_throttled(self):
+        with self.lock:
+            self.throttled += 1
+
+    def over_rate(self, max_requests_per_second):
+        """Fixed one second window, True when the request is over the limit"""
+        with self.lock:
+            now = time.monotonic()
+            if now - self.window_start >= 1.0:
+                self.window_start = now
+                self.window_requests = 0
+            self.window_requests += 1
+            return self.window_requests > max_requests_per_second
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "uptimeSeconds": time.monotonic() - self.started,
+                "requests": dict(self.requests),
+                "throttled": self.throttled,
+            }
+
+class MockSecureApiHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        LOG.debug(format % args)
+
+    def _send(self, status, body=b"", content_type="application/json", headers=None):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+        gzip_body = not self.server.args.no_gzip and "gzip" in self.headers.get("Accept-Encoding", "") and len(body) > 1024
+        if gzip_body:
+            body = gzip.compress(body, compresslevel=5)
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        if gzip_body:
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _throttle(self):
+        args = self.server.args
+        stats = self.server.stats
+        throttled = random.random() < args.throttle_rate
+        if args.max_requests_per_second != None and stats.over_rate(args.max_requests_per_second):
+            throttled = True
+        if throttled:
+            stats.add_throttled()
+            headers = {}
+            if args.retry_after != None:
+                headers["Retry-After"] = str(args.retry_after)
+            self._send(429, { "message": "Too many requests" }, headers=headers)
+        return throttled
+
+    def _handle(self, method):
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        path = url.path.rstrip("/")
+        fleet = self.server.fleet
+
+        if path == "/_mock/stats":
+            return self._send(200, self.server.stats.to_dict())
+
+        if not self.headers.get("Authorization", "").startswith("Bearer "):
+            return self._send(401, { "message": "Unauthorized" })
+
+        latency = self.server.args.latency_ms / 1000
+        if latency > 0:
+            time.sleep(random.uniform(latency / 2, latency * 1.5))
+
+        if self._throttle():
+            return
+
+        parts = path.strip("/").split("/")
+
+        if method == "GET" and path == "/secure/vulnerability/v1beta1/runtime-results":
+            self.server.stats.add("runtime-results")
+            cursor = int(query.get("cursor", ["0"])[0] or 0)
+            limit = min(int(query.get("limit", ["1000"])[0]), 1000)
+            conditions = _parse_scope_conditions(query.get("filter", [""])[0])
+            if len(conditions) == 0:
+                end = min(cursor + limit, fleet.workloads)
+                page = { "returned": end - cursor, "matched": fleet.workloads }
+                data = [ fleet.get_workload(idx) for idx in range(cursor, end) ]
+            else:
+                # the cursor is the index of the next workload to check
+                data = []
+                end = cursor
+                while end < fleet.workloads and len(data) < limit:
+                    workload = fleet.get_workload(end)
+                    if all((workload["scope"].get(field) == value) == equal for field, equal, value in conditions):
+                        data.append(workload)
+                    end += 1
+                page = { "returned": len(data) }
+            if end < fleet.workloads:
+                page["next"] = str(end)
+            return self._send(200, { "page": page, "data": data })
+
+        if method == "GET" and len(parts) == 5 and path.startswith("/secure/vulnerability/v1beta1/results/"):
+            self.server.stats.add("results")
+            image_idx = fleet.get_result_image(parts[4])
+            if image_idx == None:
+                return self._send(404, { "message": "Result not found" })
+            detail_latency = self.server.args.detail_latency_ms / 1000
+            if detail_latency > 0:
+                time.sleep(detail_latency)
+            return self._send(200, fleet.get_result_data(image_idx))
+
+        if method == "GET" and path == "/api/scanning/riskmanager/v2/definitions":
+            self.server.stats.add("riskmanager-definitions")
+            cursor = int(query.get("cursor", ["0"])[0] or 0)
+            limit = int(query.get("limit", ["100"])[0])
+            if limit > 200:
+                return self._send(400, { "message": "The limit must be at most 200" })
+            data = []
+            accept_idx = cursor
+            while accept_idx < fleet.accepts and len(data) < limit:
+                if accept_idx not in fleet.deleted_accept_ids:
+                    data.append(fleet.get_accept(accept_idx))
+                accept_idx += 1
+            next_cursor = str(accept_idx) if accept_idx < fleet.accepts else ""
+            return self._send(200, { "page": { "returned": len(data), "next": next_cursor }, "data": data })
+
+        if method == "DELETE" and len(parts) == 6 and path.startswith("/api/scanning/riskmanager/v2/definitions/"):
+            self.server.stats.add("riskmanager-definitions-delete")
+            if not fleet.delete_accept(parts[5]):
+                return self._send(404, { "message": "Definition not found" })
+            return self._send(200, {})
+
+        if method == "GET" and path == "/api/users/me":
+            self.server.stats.add("users-me")
+            return self._send(200, { "user": { "username": "benchmark@example.com", "currentTeam": 1, "teamRoles": [{ "teamId": 1, "teamName": "Benchmark" }] } })
+
+        if method == "GET" and path.startswith("/api/scanning/reporting/v2/schedules"):
+            self.server.stats.add("reporting-schedules")
+            if len(parts) == 5:
+                return self._send(200, [ { "id": f"schedule-{idx}", "name": f"Benchmark Report {idx}" } for idx in range(3) ])
+            if len(parts) == 7 and parts[6] == "status":
+                return self._send(200, { "lastCompletedReport": { "reportId": f"{parts[5]}-report", "scheduledAt": "2024-01-01T00:00:00Z", "reportFormat": "csv" } })
+            if len(parts) == 9 and parts[8] == "download":
+                return self._send(200, fleet.get_report_data(parts[7]), content_type="application/gzip")
+
+        if method == "GET" and path == "/api/cloud/v2/dataSources/agents":
+            self.server.stats.add("agents")
+            status = query.get("status", [""])[0]
+            agents = [ fleet.get_agent(idx) for idx in range(fleet.agents) ]
+            return self._send(200, { "details": [ agent for agent in agents if status == "" or agent["agentStatus"] == status ] })
+
+        self.server.stats.add("not-found")
+        self._send(404, { "message": "Not found" })
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+def _parse_scope_conditions(filter_expression):
+
+    # Only the and-ed = and != conditions on the scope are applied, every
+    # workload has asset.type workload
+    conditions = []
+    for field, operator, value in re.findall(r"([\w.]+)\s*(!=|=)\s*'([^']*)'", filter_expression):
+        if field != "asset.type":
+            conditions.append((field, operator == "=", value))
+    return conditions
+
+def _parse_args():
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--port", required=False, type=int, default=8443, action="store", help="Port to listen on (default: 8443)")
+    parser.add_argument("--cert_file", required=True, type=str, action="store", help="TLS certificate file")
+    parser.add_argument("--key_file", required=True, type=str, action="store", help="TLS private key file")
+    parser.add_argument("--workloads", required=False, type=int, default=1000, action="store", help="Number of runtime workload scan results, one per pod (default: 1000)")
+    parser.add_argument("--images", required=False, type=int, action="store", help="Number of unique images (default: workloads / 20)")
+    parser.add_argument("--pods_per_workload", required=False, type=int, default=2, action="store", help="Pods running each workload container (default: 2)")
+    parser.add_argument("--packages", required=False, type=int, default=50, action="store", help="Packages in each image scan result (default: 50)")
+    parser.add_argument("--accepts", required=False, type=int, action="store", help="Number of risk accept definitions (default: workloads / 10)")
+    parser.add_argument("--agents", required=False, type=int, action="store", help="Number of agents (default: workloads / 30)")
+    parser.add_argument("--latency_ms", required=False, type=float, default=0.0, action="store", help="Average delay added to every response (default: 0)")
+    parser.add_argument("--detail_latency_ms", required=False, type=float, default=0.0, action="store", help="Extra delay added to scan result detail responses (default: 0)")
+    parser.add_argument("--throttle_rate", required=False, type=float, default=0.0, action="store", help="Fraction of requests answered with 429 (default: 0)")
+    parser.add_argument("--max_requests_per_second", required=False, type=float, action="store", help="Answer 429 once this request rate is exceeded")
+    parser.add_argument("--retry_after", required=False, type=int, default=1, action="store", help="Retry-After seconds sent with 429 responses (default: 1)")
+    parser.add_argument("--no_gzip", required=False, action="store_true", help="Ignore Accept-Encoding and always send uncompressed responses")
+    parser.add_argument("--seed", required=False, type=int, default=1, action="store", help="Seed of the synthetic fleet (default: 1)")
+    return parser.parse_args()
+
+def main():
+
+    args = _parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), MockSecureApiHandler)
+    server.daemon_threads = True
+    server.args = args
+    server.fleet = Fleet(args)
+    server.stats = RequestStats()
+
+    ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    ssl_context.load_cert_chain(args.cert_file, args.key_file)
+    server.socket = ssl_context.wrap_socket(server.socket, server_side=True)
+
+    LOG.info(f"Serving {server.fleet.workloads} workloads, {server.fleet.images} images and {server.fleet.accepts} accepts on https://localhost:{args.port}")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        LOG.info(f"Served: {json.dumps(server.stats.to_dict())}")
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,308 @@
+"""
+  This python script will time the API scripts against the local mock Sysdig
+  Secure API server at several fleet sizes.
+
+  For each size a mock server is started with that many runtime workloads
+  and each script is run against it. The elapsed time, peak memory, exit
+  code, requests served and 429s sent by the mock server are reported for
+  every run and saved to --results_file as json. The request metrics each
+  script saves with --metrics_out are kept next to its output in --work_dir.
+
+  The delete script removes every accept so it is always run last.
+
+  Example:
+
+     python3 benchmarks/run-benchmarks.py --sizes 1000,10000 --workers 8 --latency_ms 20
+"""
+
+import argparse
+import logging
+import sys
+import os
+import json
+import ssl
+import time
+import shutil
+import subprocess
+import tempfile
+import urllib.request
+
+# Setup logger
+LOG = logging.getLogger(__name__)
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s.%(msecs)03d %(levelname)s - %(funcName)s: %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MOCK_SERVER = os.path.join(REPO_DIR, "benchmarks", "mock-sysdig-secure-api.py")
+
+# The benchmarked scripts in the order they are run, the output file name is
+# added to the command of each run
+BENCHMARKS = {
+    "runtime-report": {
+        "script": "sysdig-runtime-scanner/get-runtime-scan-workload-results.py",
+        "output_arg": "--csv_file_name",
+        "output_file": "runtime-report.csv",
+    },
+    "get-accepts": {
+        "script": "vm-accepts/get-vuln-accept-defs.py",
+        "output_arg": "--output_file",
+        "output_file": "accepts.json",
+    },
+    "cleanup-orphaned-accepts": {
+        "script": "vm-accepts/cleanup-orphaned-vuln-accepts.py",
+        "output_arg": "--output_file",
+        "output_file": "orphaned-accepts.json",
+    },
+    "delete-all-accepts": {
+        "script": "vm-accepts/delete_all_vuln_accepts.py",
+        "output_arg": None,
+        "output_file": None,
+    },
+}
+
+def _parse_args():
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--sizes",
+        required=False,
+        type=str,
+        default="1000,10000,100000",
+        action="store",
+        help="Comma separated number of runtime workloads of each run (default: 1000,10000,100000)",
+    )
+    parser.add_argument(
+        "--benchmarks",
+        required=False,
+        type=str,
+        default=",".join(BENCHMARKS.keys()),
+        action="store",
+        help=f"Comma separated benchmarks to run from {','.join(BENCHMARKS.keys())} (default: all)",
+    )
+    parser.add_argument(
+        "--workers",
+        required=False,
+        type=int,
+        default=8,
+        action="store",
+        help="Workers used by the runtime report (default: 8)",
+    )
+    parser.add_argument(
+        "--max_requests_per_second",
+        required=False,
+        type=float,
+        default=100.0,
+        action="store",
+        help="Request rate limit of the runtime report (default: 100)",
+    )
+    parser.add_argument(
+        "--latency_ms",
+        required=False,
+        type=float,
+        default=20.0,
+        action="store",
+        help="Average delay of every mock server response (default: 20)",
+    )
+    parser.add_argument(
+        "--throttle_rate",
+        required=False,
+        type=float,
+        default=0.0,
+        action="store",
+        help="Fraction of requests the mock server answers with 429 (default: 0)",
+    )
+    parser.add_argument(
+        "--port",
+        required=False,
+        type=int,
+        default=8443,
+        action="store",
+        help="Port of the mock server (default: 8443)",
+    )
+    parser.add_argument(
+        "--work_dir",
+        required=False,
+        type=str,
+        action="store",
+        help="Directory for the certificate and the script output, a temporary directory is removed after the run when not passed",
+    )
+    parser.add_argument(
+        "--results_file",
+        required=False,
+        type=str,
+        action="store",
+        help="File to save the benchmark results to as json",
+    )
+    return parser.parse_args()
+
+def main():
+
+    try:
+
+        args = _parse_args()
+        sizes = [ int(size) for size in args.sizes.split(",") if size.strip() != "" ]
+        benchmark_names = [ name.strip() for name in args.benchmarks.split(",") if name.strip() != "" ]
+
+        for name in benchmark_names:
+            if name not in BENCHMARKS:
+                LOG.error(f"ERROR: Unknown benchmark {name}, use one or more of: {','.join(BENCHMARKS.keys())}!")
+                raise SystemExit(-1)
+
+        # Keep the run order of BENCHMARKS so the accepts are deleted last
+        benchmark_names = [ name for name in BENCHMARKS if name in benchmark_names ]
+
+        if args.results_file != None and os.path.isfile(args.results_file):
+            LOG.error(f"ERROR: The results file {args.results_file} already exists!")
+            raise SystemExit(-1)
+
+        work_dir = args.work_dir
+        if work_dir == None:
+            work_dir = tempfile.mkdtemp(prefix="sysdig-benchmarks-")
+        os.makedirs(work_dir, exist_ok=True)
+
+        cert_file, key_file = _create_certificate(work_dir)
+
+        results = []
+        for size in sizes:
+            results.extend(_run_size(args, size, benchmark_names, work_dir, cert_file, key_file))
+
+        _print_results(results)
+
+        if args.results_file != None:
+            with open(args.results_file, "w") as results_output_file:
+                json.dump(results, results_output_file, indent=2)
+            LOG.info(f"Saved the benchmark results to {args.results_file}")
+
+        if args.work_dir == None:
+            shutil.rmtree(work_dir)
+
+    except Exception as e:
+        LOG.critical(e)
+        LOG.error(f"Benchmark run failed.")
+        raise SystemExit(-1)
+
+def _create_certificate(work_dir):
+
+    cert_file = os.path.join(work_dir, "cert.pem")
+    key_file = os.path.join(work_dir, "key.pem")
+
+    if not os.path.isfile(cert_file) or not os.path.isfile(key_file):
+        LOG.info(f"Creating a self signed certificate for the mock server...")
+        subprocess.run(
+            ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1", "-subj", "/CN=localhost",
+             "-addext", "subjectAltName=DNS:localhost", "-keyout", key_file, "-out", cert_file],
+            check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+
+    return cert_file, key_file
+
+def _run_size(args, size, benchmark_names, work_dir, cert_file, key_file):
+
+    LOG.info(f"Starting the mock server with {size} workloads...")
+
+    size_dir = os.path.join(work_dir, str(size))
+    if os.path.isdir(size_dir):
+        shutil.rmtree(size_dir)
+    os.makedirs(size_dir)
+
+    mock_log_file = open(os.path.join(size_dir, "mock-server.log"), "w")
+    mock_server = subprocess.Popen(
+        [sys.executable, MOCK_SERVER, "--port", str(args.port), "--cert_file", cert_file, "--key_file", key_file,
+         "--workloads", str(size), "--latency_ms", str(args.latency_ms), "--throttle_rate", str(args.throttle_rate)],
+        stdout=mock_log_file, stderr=subprocess.STDOUT,
+    )
+
+    results = []
+
+    try:
+
+        ssl_context = ssl.create_default_context(cafile=cert_file)
+        _wait_for_mock_server(args.port, ssl_context, mock_server)
+
+        env = dict(os.environ)
+        env["SSL_CERT_FILE"] = cert_file
+
+        for name in benchmark_names:
+
+            benchmark = BENCHMARKS[name]
+            metrics_file = os.path.join(size_dir, f"{name}-metrics.json")
+            command = [sys.executable, os.path.join(REPO_DIR, benchmark["script"]),
+                       "--secure_url_authority", f"localhost:{args.port}", "--api_token", "benchmark",
+                       "--metrics_out", metrics_file]
+            if benchmark["output_arg"] != None:
+                command.extend([benchmark["output_arg"], os.path.join(size_dir, benchmark["output_file"])])
+            if name == "runtime-report":
+                command.extend(["--workers", str(args.workers), "--max_requests_per_second", str(args.max_requests_per_second)])
+
+            stats_before = _get_mock_server_stats(args.port, ssl_context)
+
+            LOG.info(f"Running {name} with {size} workloads...")
+            with open(os.path.join(size_dir, f"{name}.log"), "w") as script_log_file:
+                pc_start = time.perf_counter()
+                script = subprocess.Popen(command, stdout=script_log_file, stderr=subprocess.STDOUT, env=env)
+                # wait4 returns the resource usage of this script alone
+                pid, status, rusage = os.wait4(script.pid, 0)
+                pc_end = time.perf_counter()
+                script.returncode = os.waitstatus_to_exitcode(status)
+
+            stats_after = _get_mock_server_stats(args.port, ssl_context)
+
+            output_bytes = None
+            if benchmark["output_file"] != None and os.path.isfile(os.path.join(size_dir, benchmark["output_file"])):
+                output_bytes = os.path.getsize(os.path.join(size_dir, benchmark["output_file"]))
+
+            result = {
+                "benchmark": name,
+                "workloads": size,
+                "exitCode": script.returncode,
+                "elapsedSeconds": pc_end - pc_start,
+                "maxRssMb": rusage.ru_maxrss / 1024,
+                "cpuSeconds": rusage.ru_utime + rusage.ru_stime,
+                "requests": sum(stats_after["requests"].values()) - sum(stats_before["requests"].values()),
+                "throttled": stats_after["throttled"] - stats_before["throttled"],
+                "outputBytes": output_bytes,
+            }
+            results.append(result)
+
+            LOG.info(f"Completed {name} with {size} workloads in {result['elapsedSeconds']:0.2f} seconds, exit code {result['exitCode']}.")
+
+    finally:
+        mock_server.terminate()
+        mock_server.wait()
+        mock_log_file.close()
+
+    return results
+
+def _wait_for_mock_server(port, ssl_context, mock_server, timeout=30):
+
+    deadline = time.monotonic() + timeout
+
+    while True:
+        if mock_server.poll() != None:
+            raise Exception(f"The mock server exited with code {mock_server.returncode}")
+        try:
+            _get_mock_server_stats(port, ssl_context)
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise Exception(f"The mock server did not start within {timeout} seconds")
+            time.sleep(0.2)
+
+def _get_mock_server_stats(port, ssl_context):
+
+    with urllib.request.urlopen(f"https://localhost:{port}/_mock/stats", context=ssl_context) as response:
+        return json.loads(response.read())
+
+def _print_results(results):
+
+    print(f"{'benchmark':<26} {'workloads':>10} {'exit':>5} {'seconds':>10} {'cpu secs':>10} {'max rss mb':>11} {'requests':>9} {'429s':>6}")
+    for result in results:
+        print(f"{result['benchmark']:<26} {result['workloads']:>10} {result['exitCode']:>5} {result['elapsedSeconds']:>10.2f} {result['cpuSeconds']:>10.2f} {result['maxRssMb']:>11.1f} {result['requests']:>9} {result['throttled']:>6}")
+
+if __name__ == "__main__":
+    sys.exit(main())
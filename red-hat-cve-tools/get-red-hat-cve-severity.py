@@ -24,6 +24,11 @@ import sys
 import os.path
 import requests
 import json
+import time
+
+# Rate limiter and request metrics shared with the Sysdig scripts in the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from sysdig_api_client import RateLimiter, RequestMetrics
 
 # Setup logger
 LOG = logging.getLogger(__name__)
@@ -41,6 +46,12 @@ num_of_504 = 0
 class UnexpectedHTTPResponse(Exception):
     """Used when recieving an unexpected HTTP response"""
 
+# Setup rate limiter
+rate_limiter = RateLimiter()
+
+# Track the requests made by every endpoint
+request_metrics = RequestMetrics()
+
 def _parse_args():
 
     args = None
@@ -55,14 +66,36 @@ def _parse_args():
         action="store",
         help="The CVE list file name",
     )
+    parser.add_argument(
+        "--metrics_out",
+        required=False,
+        type=str,
+        action="store",
+        help="File to save the request metrics of each endpoint to",
+    )
+    parser.add_argument(
+        "--metrics_format",
+        required=False,
+        type=str,
+        choices=["json", "prometheus"],
+        default="json",
+        action="store",
+        help="Format of the metrics file, json or prometheus text (default: json)",
+    )
     return parser.parse_args()
 
 def main():
 
+    metrics_out = None
+    run_succeeded = False
+    run_start = time.perf_counter()
+
     try:
 
         # Parse the command line arguments
         args = _parse_args()
+        metrics_out = args.metrics_out
+        metrics_format = args.metrics_format
         cve_list_file_name = args.cve_list
 
         # Validate that the cve list file exists
@@ -100,11 +133,16 @@ def main():
           print(f"{cve},{redhat_cve_severity}")
 
         LOG.info('Request for Red Hat CVE data succeeded.')
+        run_succeeded = True
 
     except Exception as e:
         LOG.critical(e)
         LOG.error(f'Request to get Red Hat CVE data failed.')
         raise SystemExit(-1)
+    finally:
+        if metrics_out != None:
+            request_metrics.save(metrics_out, metrics_format, { "run_duration_seconds": time.perf_counter() - run_start, "run_succeeded": int(run_succeeded) })
+            LOG.info(f"Saved the run metrics to {metrics_out}")
 
 def _load_cve_list(cve_list_file_name):
 
@@ -132,17 +170,24 @@ def _get_data_from_http_request(url):
         global num_of_504
         response_data = None
 
+        attempt = 0
+
         while True:
 
             LOG.debug(f"Sending http request to: {url}")
 
+            wait_start = time.perf_counter()
+            rate_limiter.acquire()
+            request_start = time.perf_counter()
             response = requests.get(url)
-            response_data = response.json()
+            request_metrics.add_request("GET", url, response.status_code, time.perf_counter() - request_start, len(response.content), request_start - wait_start, len(response.content))
 
             LOG.debug(f"Response status: {response.status_code}")
 
             if response.status_code == 200:
+                response_data = request_metrics.decode_json("GET", url, response.content)
                 #LOG.debug(f"Response data: {response_data}")
+                rate_limiter.success(response.headers)
                 break
 
             elif response.status_code in [ 429, 504 ]:
@@ -154,17 +199,12 @@ def _get_data_from_http_request(url):
                     message = "Gateway Timeout"
                     num_of_504 += 1
 
-                LOG.debug(f"Response data: {response_data}")
-                LOG.debug(f"Sleeping 60 seconds due to {message}...")
-
-                for interval in range(1,60):
-                   print(f"Sleeping {60-interval} seconds due to {message}...", end="\r")
-                   time.sleep(1)
-
-                # Extra space to clear earlier message
-                print( "Retrying request...                                    ", end="\r")
+                attempt += 1
+                delay = rate_limiter.backoff(attempt, response.headers.get("Retry-After"), response.status_code == 429)
+                request_metrics.add_backoff("GET", url, delay)
 
-                LOG.debug(f"Retrying request...")
+                LOG.debug(f"Response data: {response.text}")
+                LOG.debug(f"Retrying request in {delay:0.1f} seconds due to {message}...")
 
             elif response.status_code == 404:
 
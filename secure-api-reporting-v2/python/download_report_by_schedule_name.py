@@ -10,11 +10,13 @@ import argparse
 import logging
 import sys
 from typing import overload
-import urllib3
 import gzip
-import json
 import os
 
+# Shared Sysdig API client in the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from sysdig_api_client import SysdigApiClient
+
 # Setup logger
 LOG = logging.getLogger(__name__)
 logging.basicConfig(
@@ -24,12 +26,8 @@ logging.basicConfig(
 )
 logging.getLogger("urllib3").setLevel(logging.CRITICAL)
 
-# Setup http client
-http_client = urllib3.PoolManager()
-
-# Define custom exceptions
-class UnexpectedHTTPResponse(Exception):
-    """Used when recieving an unexpected HTTP response"""
+# Will be set by a passed arg
+api_client = None
 
 
 def _parse_args():
@@ -90,8 +88,9 @@ def main():
         authentication_bearer = args.api_token
         schedule_name = args.schedule_name
 
-        # Add the authentication header
-        http_client.headers["Authorization"] = f"Bearer {authentication_bearer}"
+        # Setup the api client
+        global api_client
+        api_client = SysdigApiClient(secure_url_authority, authentication_bearer)
 
         LOG.info(f'Request to download report from schedule "{schedule_name}" started.')
 
@@ -191,11 +190,7 @@ def main():
 
 def _get_apikey_userinfo(secure_url_authority, authentication_bearer):
 
-    api_url = f"https://{secure_url_authority}/api/users/me"
-
-    response_data = _get_data_from_http_request(api_url)
-
-    json_response = json.loads(response_data)
+    json_response = api_client.get_json("api/users/me")
 
     userinfo = {}
     userinfo["username"] = json_response["user"]["username"]
@@ -209,9 +204,7 @@ def _get_apikey_userinfo(secure_url_authority, authentication_bearer):
 
 
 def _get_report_schedules(secure_url_authority, authentication_bearer):
-    api_url = f"https://{secure_url_authority}/api/scanning/reporting/v2/schedules"
-    response_data = _get_data_from_http_request(api_url)
-    return json.loads(response_data)
+    return api_client.get_json("api/scanning/reporting/v2/schedules")
 
 
 def _get_report_schedule_id(report_schedules, schedule_name):
@@ -232,10 +225,7 @@ def _get_report_schedule_id(report_schedules, schedule_name):
 def _get_report_schedule_status(
     secure_url_authority, authentication_bearer, report_schedule_id
 ):
-    api_url = f"https://{secure_url_authority}/api/scanning/reporting/v2/schedules/{report_schedule_id}/status"
-    content_type = "application/json;charset=UTF-8"
-    response_data = _get_data_from_http_request(api_url)
-    return json.loads(response_data)
+    return api_client.get_json(f"api/scanning/reporting/v2/schedules/{report_schedule_id}/status")
 
 
 def _build_report_filename(schedule_name, report_schedule_status):
@@ -262,8 +252,8 @@ def _download_report(
 ):
 
     try:
-        api_url = f"https://{secure_url_authority}/api/scanning/reporting/v2/schedules/{schedule_id}/reports/{report_id}/download"
-        _save_data_from_http_request(url=api_url, download_filename=download_filename)
+        api_path = f"api/scanning/reporting/v2/schedules/{schedule_id}/reports/{report_id}/download"
+        _save_data_from_http_request(api_path=api_path, download_filename=download_filename)
 
     except Exception as e:
         LOG.error(f"{e}")
@@ -280,37 +270,16 @@ def decompress_file(input_filename, output_filename):
     return
 
 
-def _get_data_from_http_request(url):
+def _save_data_from_http_request(api_path, download_filename):
 
-    response_data = None
+    response = api_client.get_stream(api_path)
 
     try:
-        LOG.debug(f"Sending http request to: {url}")
-        response = http_client.request(method="GET", url=url, redirect=True)
-        response_data = response.data.decode()
-        LOG.debug(f"Response data: {response_data}")
-        if response.status != 200:
-            raise UnexpectedHTTPResponse(
-                f"Unexpected HTTP response status: {response.status}"
-            )
-
-    except Exception as e:
-        LOG.critical(e)
-        LOG.critical(f"Error while requesting url: {url}")
-        raise SystemExit()
-
-    return response_data
-
-
-def _save_data_from_http_request(url, download_filename):
-
-    with http_client.request(
-        method="GET", url=url, redirect=True, preload_content=False
-    ) as response:
-
         with open(download_filename, "wb") as outputFile:
             for chunk in response.stream(512):
                 outputFile.write(chunk)
+    finally:
+        response.release_conn()
 
 
 if __name__ == "__main__":
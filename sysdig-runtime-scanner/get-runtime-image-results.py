@@ -9,11 +9,14 @@
 import argparse
 import logging
 import sys
-import urllib3
-import json
+import os
 import urllib.parse
 from datetime import datetime
 
+# Shared Sysdig API client in the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from sysdig_api_client import SysdigApiClient
+
 # Setup logger
 LOG = logging.getLogger(__name__)
 logging.basicConfig(
@@ -23,12 +26,8 @@ logging.basicConfig(
 )
 logging.getLogger("urllib3").setLevel(logging.CRITICAL)
 
-# Setup http client
-http_client = urllib3.PoolManager()
-
-# Define custom exceptions
-class UnexpectedHTTPResponse(Exception):
-    """Used when recieving an unexpected HTTP response"""
+# Will be set by a passed arg
+api_client = None
 
 def _parse_args():
 
@@ -75,8 +74,9 @@ def main():
         now = datetime.now()
         current_datetime = now.strftime("%Y-%m-%d %H:%M")
 
-        # Add the authentication header
-        http_client.headers["Authorization"] = f"Bearer {authentication_bearer}"
+        # Setup the api client
+        global api_client
+        api_client = SysdigApiClient(secure_url_authority, authentication_bearer)
 
         #LOG.info(f'Request for runtime scan results started.')
 
@@ -113,33 +113,11 @@ def main():
 
 def _get_runtime_scan_results(secure_url_authority, authentication_bearer, image_name_filter):
 
-    api_url = f"https://{secure_url_authority}/api/scanning/runtime/v2/workflows/results?cursor&filter=freeText%20in%20%28%22{image_name_filter}%22%29&limit=100"
+    api_path = f"api/scanning/runtime/v2/workflows/results?cursor&filter=freeText%20in%20%28%22{image_name_filter}%22%29&limit=100"
 
-    response_data = _get_data_from_http_request(api_url)
-    json_response = json.loads(response_data)
+    json_response = api_client.get_json(api_path)
 
     return json_response
 
-def _get_data_from_http_request(url):
-
-    response_data = None
-
-    try:
-        LOG.debug(f"Sending http request to: {url}")
-        response = http_client.request(method="GET", url=url, redirect=True)
-        response_data = response.data.decode()
-        LOG.debug(f"Response data: {response_data}")
-        if response.status != 200:
-            raise UnexpectedHTTPResponse(
-                f"Unexpected HTTP response status: {response.status}"
-            )
-
-    except Exception as e:
-        LOG.critical(e)
-        LOG.critical(f"Error while requesting url: {url}")
-        raise SystemExit()
-
-    return response_data
-
 if __name__ == "__main__":
     sys.exit(main())
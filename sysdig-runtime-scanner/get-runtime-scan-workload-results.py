@@ -9,7 +9,10 @@
   
   The report will only retrieve "workload" results and not "host" results.
 
-  The report will only contain high and critical CVEs
+  The report will only contain high and critical CVEs by default, use
+  --severities, --fixable_only, --exploitable_only and --in_use_only to
+  choose the reported CVEs. Workloads that cannot have a matching CVE
+  are skipped before their scan result details are retrieved.
 
   The report will set Accept to True for any image or cve accept accordingly.
   If an image accept is found all cves in the image will have Accept True.
@@ -19,16 +22,79 @@
   Updated: July 20th, 2023
   Updated: Sept 20th, 2023
 
+  Use --workers to retrieve the scan result details concurrently. The
+  report output is the same regardless of the number of workers.
+
+  The scan result details are retrieved once per unique image (image id and
+  pull string) and shared by every workload running that image. The report
+  rows are written as each image is processed and are grouped by image.
+  Pods of the same workload container are reported once with their count
+  in the K8S POD count column.
+  Only the fields the report uses are kept from each scan result with the
+  values repeated across pods interned, see benchmarks/memory-benchmark.py.
+
+  Use --cache_dir to keep the scan result details between runs so that only
+  new or expired results are retrieved from the API.
+
+  Use --state_file to only retrieve the images that changed since the run
+  that saved the state, the full report is still written. Add --delta to
+  only report the added, changed and removed workloads with a Change column.
+  An unchanged image is only reused for --state_ttl_hours after it was
+  retrieved so new and expired risk accepts are picked up, a delta report
+  lists its workloads as changed when its rows differ.
+
+  Use --partitions to split the listing of the runtime results by the values
+  of a scope field, kubernetes.cluster.name unless --partition_by is passed.
+  Each value and one more partition for every other value are paginated
+  concurrently using up to --workers connections. A result found in more
+  than one partition is only reported once.
+
+  Use --columns to only write some of the report columns, in the passed
+  order. The Change and Tenant columns are always added when reported. A
+  resumed run must be passed the same columns. With --sqlite_out the
+  columns queried by vm-metrics/create-vm-metrics-report.py are required.
+
+  Use --stream_json to parse very large scan results while they are
+  downloaded instead of loading them whole, this requires the ijson package.
+
+  Progress is checkpointed to <output file name>.checkpoint while the report
+  runs. Use --resume to continue a failed run from its checkpoint.
+
+  Use --sqlite_out instead of --csv_file_name to write the report rows
+  straight to the vulns table that vm-metrics/load-vm-report-to-db.py
+  creates, so vm-metrics/create-vm-metrics-report.py can be run on it
+  without the csv round trip.
+
+  Use --metrics_out to save the request count, latency histogram, bytes
+  received, retries, backoff time and json decode time of each API endpoint
+  as json or, with --metrics_format prometheus, in the Prometheus text format.
+
+  Use --tenants_file instead of --secure_url_authority and --api_token to
+  report on several tenants (regions or teams) at once. The file is a json
+  list of tenants:
+
+     [
+       { "name": "us-east", "secure_url_authority": "secure.sysdig.com", "api_token": "..." },
+       { "name": "eu-central", "secure_url_authority": "eu1.app.sysdig.com", "api_token_env": "EU_API_TOKEN" }
+     ]
+
+  where api_token_env names an environment variable holding the token.
+  Each tenant runs in its own process of a pool of --tenant_processes with
+  its own connection pool and rate limit, so a throttled tenant does not
+  slow down the others. The rows of every tenant are merged into the one
+  output file, in the order of the tenants file, with a Tenant column. The
+  output file is only written when every tenant succeeds. The
+  --cache_dir keeps a sub directory and --metrics_out a file per tenant. A
+  multi tenant run cannot use --state_file or --resume.
+
   TODO:
      - add support for Vuln Link column: report_row.append('TODO') ### "Vuln link"
-     - add support for K8S POD count column: report_row.append('TODO') ### "K8S POD count"
      - (SSPROD-30497) bug solution date is blank sometimes when the runtime report and ui are not
 """
 
 import argparse
 import logging
 import sys
-import urllib3
 import json
 import urllib.parse
 from datetime import datetime
@@ -39,6 +105,27 @@ import platform
 import time
 import csv
 import os.path
+import threading
+import itertools
+import operator
+import sqlite3
+import zlib
+import gzip
+from collections import deque
+
+# Optional, only needed to stream the scan result details with --stream_json
+try:
+    import ijson
+except ImportError:
+    ijson = None
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import re
+import shutil
+import tempfile
+
+# Shared Sysdig API client in the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from sysdig_api_client import SysdigApiClient
 
 # Setup logger
 LOG = logging.getLogger(__name__)
@@ -47,21 +134,391 @@ logging.basicConfig(
     format="%(asctime)s.%(msecs)03d %(levelname)s - %(funcName)s: %(message)s",
     datefmt="%Y-%m-%d %H:%M:%S",
 )
-logging.getLogger("urllib3").setLevel(logging.CRITICAL)
 
-# Setup http client
-http_client = urllib3.PoolManager()
+# Will be set by a passed arg
+api_client = None
+runtime_filter = ""
+runtime_partitions = None
+
+# The vuln severities accepted by --severities
+VULN_SEVERITIES = ["critical", "high", "medium", "low", "negligible"]
+
+# The report columns, the vuln columns come first followed by the kubernetes
+# columns of the workload, the image id, the pod count and the package columns
+REPORT_HEADERS = [
+    "Vulnerability ID",
+    "Severity",
+    "Package name",
+    "Package version",
+    "Package type",
+    "Package path",
+    "Image",
+    "OS Name",
+    "CVSS version",
+    "CVSS score",
+    "CVSS vector",
+    "Vuln link",
+    "Vuln Publish date",
+    "Vuln Fix date",
+    "Fix version",
+    "Public Exploit",
+    "K8S cluster name",
+    "K8S namespace name",
+    "K8S workload type",
+    "K8S workload name",
+    "K8S container name",
+    "Image ID",
+    "K8S POD count",
+    "Package suggested fix",
+    "In use",
+    "Risk accepted",
+]
+
+# The report columns queried by vm-metrics/create-vm-metrics-report.py
+SQLITE_REQUIRED_HEADERS = [
+    "Severity",
+    "Image",
+    "Vuln Fix date",
+    "K8S cluster name",
+    "Image ID",
+    "K8S POD count",
+]
+
+# The scope fields of the kubernetes report columns, in column order
+WORKLOAD_SCOPE_FIELDS = [
+    "kubernetes.cluster.name",
+    "kubernetes.namespace.name",
+    "kubernetes.workload.type",
+    "kubernetes.workload.name",
+    "kubernetes.pod.container.name",
+]
+
+# Values shared by many workload results are only kept once
+interned_values = {}
+
+def _intern(value):
+    return interned_values.setdefault(value, value)
+
+class WorkloadResult:
+    """
+    Compact record of a runtime workload scan result that keeps only what
+    the report uses. There is a result for every pod and the same cluster,
+    namespace, workload, image and vuln totals repeat across them, so those
+    values are interned and every pod of a workload shares one tuple.
+    """
+
+    __slots__ = ("result_id", "image_key", "workload", "vuln_totals", "running_vuln_totals")
+
+    def __init__(self, result):
+        self.result_id = _intern(result["resultId"])
+        self.image_key = _intern(_get_image_key(result))
+        self.workload = _intern(tuple([ _intern(result["scope"][field]) for field in WORKLOAD_SCOPE_FIELDS ]))
+        self.vuln_totals = _intern(tuple([ result["vulnTotalBySeverity"].get(severity, 0) for severity in VULN_SEVERITIES ]))
+        self.running_vuln_totals = None
+        if "runningVulnTotalBySeverity" in result:
+            self.running_vuln_totals = _intern(tuple([ result["runningVulnTotalBySeverity"].get(severity, 0) for severity in VULN_SEVERITIES ]))
+
+    def to_result(self):
+        # the image key is kept as the resource id and pull string so it is
+        # the same when read back
+        result = {
+            "resultId": self.result_id,
+            "resourceId": self.image_key[0],
+            "mainAssetName": self.image_key[1],
+            "scope": dict(zip(WORKLOAD_SCOPE_FIELDS, self.workload)),
+            "vulnTotalBySeverity": dict(zip(VULN_SEVERITIES, self.vuln_totals)),
+        }
+        if self.running_vuln_totals != None:
+            result["runningVulnTotalBySeverity"] = dict(zip(VULN_SEVERITIES, self.running_vuln_totals))
+        return result
+
+class ResultCache:
+    """
+    SQLite cache of the scan result details keyed by result id. Entries
+    expire after the ttl and the least recently used entries are evicted
+    when the cache grows beyond its maximum size.
+    """
+
+    def __init__(self, cache_dir, ttl_seconds=86400, max_bytes=1024 * 1024 * 1024):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.uncommitted = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(cache_dir, "runtime-results-cache.db"), check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS results (result_id TEXT PRIMARY KEY, stored_at REAL, accessed_at REAL, size INTEGER, data BLOB)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS results_accessed_at ON results (accessed_at)")
+        self.conn.commit()
+
+    def get(self, result_id):
+        with self.lock:
+            now = time.time()
+            row = self.conn.execute("SELECT stored_at, data FROM results WHERE result_id = ?", (result_id,)).fetchone()
+            if row is None or now - row[0] > self.ttl_seconds:
+                self.misses += 1
+                return None
+            self.conn.execute("UPDATE results SET accessed_at = ? WHERE result_id = ?", (now, result_id))
+            self.hits += 1
+            return zlib.decompress(row[1]).decode()
+
+    def put(self, result_id, response_data):
+        self.put_compressed(result_id, zlib.compress(response_data.encode()))
+
+    def put_compressed(self, result_id, data):
+        with self.lock:
+            now = time.time()
+            self.conn.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)", (result_id, now, now, len(data), data))
+            self.uncommitted += 1
+            if self.uncommitted >= 100:
+                self.conn.commit()
+                self.uncommitted = 0
+
+    def close(self):
+        """Remove expired entries, evict down to the maximum size and save"""
+        with self.lock:
+            self.conn.execute("DELETE FROM results WHERE stored_at < ?", (time.time() - self.ttl_seconds,))
+            total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+            if total_bytes > self.max_bytes:
+                evict_ids = []
+                for result_id, size in self.conn.execute("SELECT result_id, size FROM results ORDER BY accessed_at"):
+                    if total_bytes <= self.max_bytes:
+                        break
+                    evict_ids.append((result_id,))
+                    total_bytes -= size
+                self.conn.executemany("DELETE FROM results WHERE result_id = ?", evict_ids)
+                LOG.info(f"Evicted {len(evict_ids)} scan results from the cache.")
+            self.conn.commit()
+            self.conn.close()
+
+class Checkpoint:
+    """
+    Append only json lines file recording the runtime results pages and the
+    images written to the report file so that a failed run can be resumed.
+    """
+
+    def __init__(self, checkpoint_file_name, resume=False):
+        self.checkpoint_file_name = checkpoint_file_name
+        self.scan_results = []
+        self.cursor = ""
+        self.listed = False
+        self.columns = None
+        self.csv_offset = None
+        self.completed_image_keys = set()
+        if resume and os.path.isfile(checkpoint_file_name):
+            self._load()
+            self.checkpoint_file = open(checkpoint_file_name, "a")
+        else:
+            self.checkpoint_file = open(checkpoint_file_name, "w")
+
+    def _load(self):
+        with open(self.checkpoint_file_name, "r") as checkpoint_input_file:
+            for line in checkpoint_input_file:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # the last line is incomplete when the run was killed while writing it
+                    break
+                if entry["type"] == "page":
+                    self.scan_results.extend([ WorkloadResult(result) for result in entry["data"] ])
+                    self.cursor = entry["next"]
+                    self.listed = entry["next"] == None
+                elif entry["type"] == "columns":
+                    self.columns = entry["columns"]
+                elif entry["type"] == "header":
+                    self.csv_offset = entry["offset"]
+                elif entry["type"] == "image":
+                    self.completed_image_keys.add(_load_image_key(entry["imageKey"]))
+                    self.csv_offset = entry["offset"]
+
+    def _write(self, entry):
+        self.checkpoint_file.write(json.dumps(entry) + "\n")
+        self.checkpoint_file.flush()
+
+    def add_columns(self, columns):
+        self._write({ "type": "columns", "columns": columns })
+
+    def add_page(self, data, next_cursor):
+        self._write({ "type": "page", "next": next_cursor, "data": data })
+
+    def add_listed_results(self, scan_results):
+        # written one result at a time so the whole list is never held as
+        # dicts, an incomplete line is skipped when loading
+        self.checkpoint_file.write('{"type": "page", "next": null, "data": [')
+        for idx, result in enumerate(scan_results):
+            if idx > 0:
+                self.checkpoint_file.write(", ")
+            self.checkpoint_file.write(json.dumps(result.to_result()))
+        self.checkpoint_file.write("]}\n")
+        self.checkpoint_file.flush()
+
+    def add_header(self, csv_offset):
+        self._write({ "type": "header", "offset": csv_offset })
+
+    def add_image(self, image_key, csv_offset):
+        self._write({ "type": "image", "imageKey": image_key, "offset": csv_offset })
+
+    def remove(self):
+        self.checkpoint_file.close()
+        os.remove(self.checkpoint_file_name)
+
+class SqliteReportFile:
+    """
+    Writes the report rows to the vulns table loaded by the vm-metrics
+    scripts using batched transactions. Like the csv file, flush commits the
+    pending rows and tell returns the position to resume from, which is the
+    number of rows committed.
+    """
+
+    def __init__(self, db_file_name, row_offset=None, batch_size=10000):
+        self.conn = sqlite3.connect(db_file_name)
+        self.batch_size = batch_size
+        self.insert_sql = None
+        self.pending_rows = []
+        self.row_count = 0
+        if row_offset != None:
+            # drop the rows of the image that was being written
+            self.conn.execute("DELETE FROM vulns WHERE rowid > ?", (row_offset,))
+            self.conn.commit()
+            self.row_count = row_offset
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type == None:
+            self.flush()
+        self.conn.close()
+
+    def table_writer(self, report_headers):
+        # the column names of load-vm-report-to-db.py, e.g. "K8S POD count" -> K8S_POD_count
+        columns = [ header.replace(" ", "_") for header in report_headers ]
+        self.conn.execute(f"CREATE TABLE IF NOT EXISTS vulns ({', '.join(f'{column} TEXT' for column in columns)})")
+        self.conn.commit()
+        self.insert_sql = f"INSERT INTO vulns ({', '.join(columns)}) VALUES({', '.join('?' * len(columns))})"
+        return self
+
+    def writerows(self, rows):
+        for row in rows:
+            # store the values as the csv file would
+            self.pending_rows.append([ value if type(value) is str else ('' if value is None else str(value)) for value in row ])
+            if len(self.pending_rows) >= self.batch_size:
+                self._insert_pending_rows()
+
+    def _insert_pending_rows(self):
+        if len(self.pending_rows) > 0:
+            self.conn.executemany(self.insert_sql, self.pending_rows)
+            self.row_count += len(self.pending_rows)
+            self.pending_rows = []
+
+    def flush(self):
+        if self.insert_sql != None:
+            self._insert_pending_rows()
+        self.conn.commit()
+
+    def tell(self):
+        return self.row_count
+
+# Will be set when a cache directory is passed
+result_cache = None
+
+# Will be set when streaming the scan result details
+stream_json = False
+
+class ReportRowBuilder:
+    """
+    Builds the report rows of the passed column indexes. The vuln rows of an
+    image are split around the kubernetes columns, the image id and the pod
+    count of the workload. The requested values of each vuln row are picked
+    once per image and those of the workload once per workload, so a row only
+    joins the two and a narrower report does less work.
+    """
+
+    def __init__(self, columns):
+        # The full report joins the whole parts of each row
+        self.all_columns = list(columns) == list(range(len(REPORT_HEADERS)))
+
+        workload_start = REPORT_HEADERS.index("K8S cluster name")
+        image_id_idx = REPORT_HEADERS.index("Image ID")
+        pod_count_idx = REPORT_HEADERS.index("K8S POD count")
+
+        head_columns = sorted([ column_idx for column_idx in columns if column_idx < workload_start ])
+        workload_columns = sorted([ column_idx for column_idx in columns if workload_start <= column_idx < image_id_idx ])
+        tail_columns = sorted([ column_idx for column_idx in columns if column_idx > pod_count_idx ])
+
+        self.get_head = self._get_items(head_columns, workload_start)
+        self.get_workload = self._get_items([ column_idx - workload_start for column_idx in workload_columns ], image_id_idx - workload_start)
+        self.get_tail = self._get_items([ column_idx - pod_count_idx - 1 for column_idx in tail_columns ], len(REPORT_HEADERS) - pod_count_idx - 1)
+        self.with_image_id = image_id_idx in columns
+        self.with_pod_count = pod_count_idx in columns
+
+        # A row joins the picked image values and the picked workload values,
+        # they are put in the requested order unless they already are
+        joined_columns = head_columns + ([ image_id_idx ] if self.with_image_id else []) + tail_columns
+        joined_columns += workload_columns + ([ pod_count_idx ] if self.with_pod_count else [])
+        self.reorder = None
+        if joined_columns != list(columns):
+            self.reorder = operator.itemgetter(*[ joined_columns.index(column_idx) for column_idx in columns ])
+
+    def _get_items(self, item_idxs, part_length):
+        if len(item_idxs) == 0:
+            return lambda part: ()
+        if item_idxs == list(range(part_length)):
+            return tuple
+        if len(item_idxs) == 1:
+            # itemgetter returns the value itself for a single index
+            item_idx = item_idxs[0]
+            return lambda part: (part[item_idx],)
+        return operator.itemgetter(*item_idxs)
+
+    def project_image_rows(self, image_vuln_rows):
+        if image_vuln_rows is None or self.all_columns:
+            return image_vuln_rows
+        if self.with_image_id:
+            return [ self.get_head(head) + (image_id,) + self.get_tail(tail) for image_id, head, tail in image_vuln_rows ]
+        return [ self.get_head(head) + self.get_tail(tail) for image_id, head, tail in image_vuln_rows ]
+
+    def build_rows(self, projected_rows, workload_columns, pod_count, change=None):
+        change_values = (change,) if change != None else ()
+        if self.all_columns:
+            for image_id, head, tail in projected_rows:
+                yield (*head, *workload_columns, image_id, pod_count, *tail, *change_values)
+            return
+        workload_values = self.get_workload(workload_columns)
+        if self.with_pod_count:
+            workload_values += (pod_count,)
+        reorder = self.reorder
+        if reorder == None:
+            workload_values += change_values
+            for image_values in projected_rows:
+                yield image_values + workload_values
+        else:
+            for image_values in projected_rows:
+                yield reorder(image_values + workload_values) + change_values
 
-# Track number of http response codes
-num_of_429 = 0
-num_of_504 = 0
+# Will be set to the indexes of the passed report columns
+report_columns = None
 
-# Will be set by a passed arg
-secure_url_authority = ""
+class CompressingReader:
+    """
+    Reads a response while keeping a compressed copy of the data read so a
+    streamed scan result can still be saved to the cache.
+    """
 
-# Define custom exceptions
-class UnexpectedHTTPResponse(Exception):
-    """Used when recieving an unexpected HTTP response"""
+    def __init__(self, response):
+        self.response = response
+        self.compressor = zlib.compressobj()
+        self.chunks = []
+
+    def read(self, size=-1):
+        data = self.response.read(size)
+        self.chunks.append(self.compressor.compress(data))
+        return data
+
+    def compressed_data(self):
+        self.chunks.append(self.compressor.flush())
+        return b"".join(self.chunks)
 
 def _parse_args():
 
@@ -72,55 +529,316 @@ def _parse_args():
     )
     parser.add_argument(
         "--secure_url_authority",
-        required=True,
+        required=False,
         type=str,
         action="store",
-        help="authority component of secure url",
+        help="authority component of secure url (required without --tenants_file)",
     )
     parser.add_argument(
         "--api_token",
-        required=True,
+        required=False,
         type=str,
         action="store",
-        help="Sysdig Secure API Token",
+        help="Sysdig Secure API Token (required without --tenants_file)",
     )
     parser.add_argument(
+        "--tenants_file",
+        required=False,
+        type=str,
+        action="store",
+        help="JSON file of the tenants to report on concurrently, each with a name, secure_url_authority and api_token or api_token_env",
+    )
+    parser.add_argument(
+        "--tenant_processes",
+        required=False,
+        type=int,
+        default=4,
+        action="store",
+        help="Number of tenants reported on at the same time with --tenants_file (default: 4)",
+    )
+    output = parser.add_mutually_exclusive_group(required=True)
+    output.add_argument(
         "--csv_file_name",
-        required=True,
         type=str,
         action="store",
         help="CSV output file name",
     )
+    output.add_argument(
+        "--sqlite_out",
+        type=str,
+        action="store",
+        help="SQLite output database file name, the rows are written to the vulns table used by vm-metrics",
+    )
+    parser.add_argument(
+        "--severities",
+        required=False,
+        type=str,
+        default="critical,high",
+        action="store",
+        help=f"Comma separated vuln severities to report from {','.join(VULN_SEVERITIES)} (default: critical,high)",
+    )
+    parser.add_argument(
+        "--fixable_only",
+        required=False,
+        action="store_true",
+        help="Only report vulns with a fix version",
+    )
+    parser.add_argument(
+        "--exploitable_only",
+        required=False,
+        action="store_true",
+        help="Only report vulns with a public exploit",
+    )
+    parser.add_argument(
+        "--in_use_only",
+        required=False,
+        action="store_true",
+        help="Only report vulns in packages that are in use",
+    )
+    parser.add_argument(
+        "--runtime_filter",
+        required=False,
+        type=str,
+        action="store",
+        help="Additional runtime results filter expression, e.g. \"kubernetes.cluster.name = 'prod'\"",
+    )
+    parser.add_argument(
+        "--partitions",
+        required=False,
+        type=str,
+        action="store",
+        help="Comma separated values of --partition_by to list the runtime results of concurrently, e.g. \"prod,staging\"",
+    )
+    parser.add_argument(
+        "--partition_by",
+        required=False,
+        type=str,
+        default="kubernetes.cluster.name",
+        action="store",
+        help="Scope field the --partitions values are matched against (default: kubernetes.cluster.name)",
+    )
+    parser.add_argument(
+        "--columns",
+        required=False,
+        type=str,
+        action="store",
+        help="Comma separated report columns to write in that order, e.g. \"Vulnerability ID,Severity,Image,K8S cluster name\" (default: all)",
+    )
+    parser.add_argument(
+        "--workers",
+        required=False,
+        type=int,
+        default=1,
+        action="store",
+        help="Number of concurrent requests used to retrieve scan result details (default: 1)",
+    )
+    parser.add_argument(
+        "--max_requests_per_second",
+        required=False,
+        type=float,
+        default=20.0,
+        action="store",
+        help="Upper limit of the request rate shared by all workers (default: 20)",
+    )
+    parser.add_argument(
+        "--stream_json",
+        required=False,
+        action="store_true",
+        help="Parse the scan result details while they are downloaded, requires the ijson package",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        required=False,
+        type=str,
+        action="store",
+        help="Directory used to cache scan result details between runs",
+    )
+    parser.add_argument(
+        "--cache_ttl_hours",
+        required=False,
+        type=float,
+        default=24.0,
+        action="store",
+        help="Hours a cached scan result is used before it is retrieved again (default: 24)",
+    )
+    parser.add_argument(
+        "--cache_max_mb",
+        required=False,
+        type=float,
+        default=1024.0,
+        action="store",
+        help="Maximum cache size in MB, least recently used results are evicted first (default: 1024)",
+    )
+    parser.add_argument(
+        "--state_file",
+        required=False,
+        type=str,
+        action="store",
+        help="State file of the previous run, only changed images are retrieved and the file is updated",
+    )
+    parser.add_argument(
+        "--state_ttl_hours",
+        required=False,
+        type=float,
+        default=24.0,
+        action="store",
+        help="Hours an unchanged image is reused from the state file before it is retrieved again (default: 24)",
+    )
+    parser.add_argument(
+        "--delta",
+        required=False,
+        action="store_true",
+        help="Only report the workloads added, changed or removed since the previous run (requires --state_file)",
+    )
+    parser.add_argument(
+        "--resume",
+        required=False,
+        action="store_true",
+        help="Resume a failed run from the checkpoint saved next to the output file",
+    )
+    parser.add_argument(
+        "--metrics_out",
+        required=False,
+        type=str,
+        action="store",
+        help="File to save the request metrics of each endpoint to",
+    )
+    parser.add_argument(
+        "--metrics_format",
+        required=False,
+        type=str,
+        choices=["json", "prometheus"],
+        default="json",
+        action="store",
+        help="Format of the metrics file, json or prometheus text (default: json)",
+    )
     return parser.parse_args()
 
 def main():
 
+    metrics_out = None
+    run_succeeded = False
+    run_start = time.perf_counter()
+
     try:
 
         # Parse the command line arguments
         args = _parse_args()
-        global secure_url_authority
-        secure_url_authority = args.secure_url_authority
+        metrics_out = args.metrics_out
+        metrics_format = args.metrics_format
         authentication_bearer = args.api_token
         csv_file_name = args.csv_file_name
+        sqlite_file_name = args.sqlite_out
+        report_file_name = sqlite_file_name if sqlite_file_name != None else csv_file_name
+        workers = args.workers
+
+        global runtime_filter
+        if args.runtime_filter != None:
+            runtime_filter = args.runtime_filter
+
+        global runtime_partitions
+        runtime_partitions = _get_runtime_partitions(args)
+
+        global report_columns
+        report_columns = _get_report_columns(args)
+
+        vuln_filter = {
+            "severities": [ severity.strip().lower() for severity in args.severities.split(",") if severity.strip() != "" ],
+            "fixable_only": args.fixable_only,
+            "exploitable_only": args.exploitable_only,
+            "in_use_only": args.in_use_only,
+        }
+
+        if len(vuln_filter["severities"]) == 0 or not set(vuln_filter["severities"]).issubset(VULN_SEVERITIES):
+            LOG.error(f"ERROR: The severities must be one or more of: {','.join(VULN_SEVERITIES)}!")
+            raise SystemExit(-1)
+
+        if workers < 1:
+            LOG.error(f"ERROR: The number of workers must be at least 1!")
+            raise SystemExit(-1)
+
+        if args.max_requests_per_second <= 0:
+            LOG.error(f"ERROR: The maximum requests per second must be greater than 0!")
+            raise SystemExit(-1)
+
+        state_file = args.state_file
+        delta_report = args.delta
+
+        if delta_report and state_file == None:
+            LOG.error(f"ERROR: A delta report requires a state file!")
+            raise SystemExit(-1)
+
+        tenants = None
+        if args.tenants_file != None:
+            if args.secure_url_authority != None or args.api_token != None:
+                LOG.error(f"ERROR: Use either --tenants_file or --secure_url_authority and --api_token!")
+                raise SystemExit(-1)
+            if state_file != None or args.resume:
+                LOG.error(f"ERROR: A multi tenant run cannot use a state file or be resumed!")
+                raise SystemExit(-1)
+            if args.tenant_processes < 1:
+                LOG.error(f"ERROR: The number of tenant processes must be at least 1!")
+                raise SystemExit(-1)
+            tenants = _load_tenants(args.tenants_file)
+        elif args.secure_url_authority == None or args.api_token == None:
+            LOG.error(f"ERROR: The --secure_url_authority and --api_token are required without --tenants_file!")
+            raise SystemExit(-1)
 
-        if os.path.isfile(csv_file_name):
-            LOG.error(f"ERROR: The output csv file {csv_file_name} already exists!")
+        checkpoint_file_name = f"{report_file_name}.checkpoint"
+        resume = args.resume and os.path.isfile(checkpoint_file_name)
+
+        if args.resume and state_file != None:
+            LOG.error(f"ERROR: A run using a state file cannot be resumed!")
             raise SystemExit(-1)
 
+        if args.resume and not resume:
+            LOG.warning(f"No checkpoint {checkpoint_file_name} found, starting a new run.")
+
+        if os.path.isfile(report_file_name) and not resume:
+            LOG.error(f"ERROR: The output file {report_file_name} already exists!")
+            raise SystemExit(-1)
+
+        global stream_json
+        if args.stream_json:
+            if ijson == None:
+                LOG.error(f"ERROR: Streaming the scan results requires the ijson package, install it with: pip install ijson")
+                raise SystemExit(-1)
+            stream_json = True
+
+        if tenants != None:
+            run_succeeded = _run_tenants(tenants, args, vuln_filter)
+            if not run_succeeded:
+                raise SystemExit(-1)
+            return
+
+        global result_cache
+        if args.cache_dir != None:
+            result_cache = ResultCache(args.cache_dir, args.cache_ttl_hours * 3600, int(args.cache_max_mb * 1024 * 1024))
+
         # Get the timestamp of this run
         now = datetime.now()
         current_datetime = now.strftime("%Y-%m-%d %H:%M")
 
-        # Add the authentication header
-        http_client.headers["Authorization"] = f"Bearer {authentication_bearer}"
+        # Size the connection pool so every worker can keep a connection alive
+        global api_client
+        api_client = SysdigApiClient(args.secure_url_authority, authentication_bearer, max_connections=workers, max_requests_per_second=args.max_requests_per_second)
 
         # Start performance counter
         pc_start = time.perf_counter()
 
+        # Checkpoint the run so it can be resumed
+        checkpoint = Checkpoint(checkpoint_file_name, resume)
+        if resume and checkpoint.columns != report_columns:
+            LOG.error(f"ERROR: The checkpoint was written with other report columns, resume with the same --columns!")
+            raise SystemExit(-1)
+        if not resume:
+            checkpoint.add_columns(report_columns)
+        if resume:
+            LOG.info(f"Resuming from checkpoint {checkpoint_file_name} with {len(checkpoint.scan_results)} scan results and {len(checkpoint.completed_image_keys)} images completed.")
+
         # Get the runtime workload scan results
         LOG.info(f"Retrieving the list of runtime workload scan results...")
-        scan_results_list = _get_runtime_workload_scan_results_list()
+        scan_results_list = _get_runtime_workload_scan_results_list(checkpoint, workers)
         LOG.info(f"Found {len(scan_results_list)} total scan results.")
         
         if len(scan_results_list) == 0:
@@ -129,233 +847,733 @@ def main():
         else:
 
             # Get the list of runtime workload scan results with vulnerabilities
-            LOG.info(f"Searching for runtime workload scan results with vulnerabilities...")
-            scan_results_list_with_vulns = _get_scan_results_list_with_vulnerabilties(scan_results_list)
+            LOG.info(f"Searching for runtime workload scan results with {','.join(vuln_filter['severities'])} vulnerabilities...")
+            scan_results_list_with_vulns = _get_scan_results_list_with_vulnerabilties(scan_results_list, vuln_filter)
             LOG.info(f"Found {len(scan_results_list_with_vulns)} scan results with vulnerabilities.")
             LOG.info(f"Found {len(scan_results_list) - len(scan_results_list_with_vulns)} scan results with no vulnerabilities.")
 
-            # Get the image scan results for workloads with vulnerabilities
+            # Load the state of the previous run
+            previous_state = None
+            workload_changes = None
+            if state_file != None and os.path.isfile(state_file):
+                LOG.info(f"Loading the previous run state from {state_file}...")
+                previous_state = _load_state(state_file)
+                if previous_state["filter"] != vuln_filter:
+                    LOG.warning(f"The vuln filter changed since the previous run, all images will be retrieved.")
+                    previous_state["images"] = {}
+                workload_changes = _get_workload_changes(scan_results_list_with_vulns, previous_state)
+                LOG.info(f"Found {workload_changes['counts']['added']} added, {workload_changes['counts']['changed']} changed and {len(workload_changes['removed'])} removed workloads.")
+            elif delta_report:
+                LOG.warning(f"The state file {state_file} does not exist, all workloads will be reported as added.")
+                workload_changes = _get_workload_changes(scan_results_list_with_vulns, { "filter": vuln_filter, "workloads": {}, "images": {} })
+
+            # Get the image scan results for workloads with vulnerabilities as they are retrieved
             LOG.info(f"Retrieving runtime scan results for images with vulnerabilities...")
-            images_with_vulns_scan_results = _get_image_scan_results(scan_results_list_with_vulns)
-            LOG.info(f"Found {len(images_with_vulns_scan_results)} runtime image scan results.")
+            images_vuln_rows = _get_images_vuln_rows(scan_results_list_with_vulns, vuln_filter, workers, previous_state, checkpoint.completed_image_keys, args.state_ttl_hours * 3600)
+
+            # Save the state of this run as the image rows are gathered
+            state_output_file = None
+            if state_file != None:
+                state_output_file = gzip.open(f"{state_file}.tmp", "wt")
+                images_vuln_rows = _save_state(state_output_file, scan_results_list_with_vulns, vuln_filter, images_vuln_rows, previous_state)
+
+            # Open the report file, a resumed run continues after the last
+            # image that was completely written
+            if sqlite_file_name != None:
+                report_output_file = SqliteReportFile(sqlite_file_name, checkpoint.csv_offset)
+            elif checkpoint.csv_offset != None:
+                report_output_file = open(csv_file_name, 'r+')
+                report_output_file.seek(checkpoint.csv_offset)
+                report_output_file.truncate()
+            else:
+                report_output_file = open(csv_file_name, 'w')
 
-            # Gather the report data
-            report_data = _gather_report_data(scan_results_list_with_vulns, images_with_vulns_scan_results)
+            # Checkpoint each image once its rows are written
+            images_vuln_rows = _checkpoint_images(checkpoint, report_output_file, images_vuln_rows)
+
+            # Gather the report data for each image
+            if delta_report:
+                report_data = _gather_report_data(scan_results_list_with_vulns, images_vuln_rows, workload_changes, previous_state)
+            else:
+                report_data = _gather_report_data(scan_results_list_with_vulns, images_vuln_rows)
             
-            # Save the report data to a csv file
-            with open(csv_file_name, 'w') as csv_output_file:
-                write = csv.writer(csv_output_file)
+            # Save the report data to the report file as it is gathered
+            with report_output_file:
+                report_headers = next(report_data)
+                if sqlite_file_name != None:
+                    write = report_output_file.table_writer(report_headers)
+                else:
+                    write = csv.writer(report_output_file)
+                    if checkpoint.csv_offset == None:
+                        write.writerow(report_headers)
+                if checkpoint.csv_offset == None:
+                    report_output_file.flush()
+                    checkpoint.add_header(report_output_file.tell())
                 write.writerows(report_data)
 
+            if state_output_file != None:
+                state_output_file.close()
+                os.replace(f"{state_file}.tmp", state_file)
+                LOG.info(f"Saved the run state to {state_file}")
+
         #end if
 
+        checkpoint.remove()
+
+        if result_cache != None:
+            LOG.info(f"Scan result cache hits: {result_cache.hits}, misses: {result_cache.misses}.")
+            result_cache.close()
+
         # End performance counter
         pc_end = time.perf_counter()
         elapsed_seconds = pc_end - pc_start
         execution_time = "{}".format(str(timedelta(seconds=elapsed_seconds)))
 
         LOG.info(f"Elapsed execution time: {execution_time}")
-        LOG.info(f"HTTP Response Code 429 occurred: {num_of_429} times.")
-        LOG.info(f"HTTP Response Code 504 occurred: {num_of_504} times.")
+        LOG.info(f"HTTP Response Code 429 occurred: {api_client.num_of_429} times.")
+        LOG.info(f"HTTP Response Code 504 occurred: {api_client.num_of_504} times.")
         LOG.info(f'Request for runtime scan results complete.')
+        run_succeeded = True
 
     except Exception as e:
         LOG.critical(e)
         LOG.error(f'Request to download runtime results failed.')
         raise SystemExit(-1)
+    finally:
+        if metrics_out != None and api_client != None:
+            api_client.save_metrics(metrics_out, metrics_format, { "run_duration_seconds": time.perf_counter() - run_start, "run_succeeded": int(run_succeeded) })
+            LOG.info(f"Saved the run metrics to {metrics_out}")
+
+def _load_tenants(tenants_file_name):
+
+    with open(tenants_file_name) as tenants_file:
+        tenants = json.load(tenants_file)
+
+    if not isinstance(tenants, list) or len(tenants) == 0:
+        LOG.error(f"ERROR: The tenants file {tenants_file_name} must be a json list of one or more tenants!")
+        raise SystemExit(-1)
+
+    tenant_names = set()
+    for tenant in tenants:
+        if tenant.get("name") in (None, "") or tenant.get("secure_url_authority") in (None, ""):
+            LOG.error(f"ERROR: Every tenant in {tenants_file_name} needs a name and a secure_url_authority!")
+            raise SystemExit(-1)
+        if tenant["name"] in tenant_names:
+            LOG.error(f"ERROR: The tenant name {tenant['name']} is used more than once!")
+            raise SystemExit(-1)
+        tenant_names.add(tenant["name"])
+        if tenant.get("api_token") == None and tenant.get("api_token_env") != None:
+            tenant["api_token"] = os.environ.get(tenant["api_token_env"])
+        if tenant.get("api_token") in (None, ""):
+            LOG.error(f"ERROR: No api token found for the tenant {tenant['name']}!")
+            raise SystemExit(-1)
+
+    return tenants
+
+def _tenant_file_name(file_name, tenant_name):
+
+    # Keep the tenant name safe to use in a file name
+    root, ext = os.path.splitext(file_name)
+    return f"{root}-{re.sub(r'[^A-Za-z0-9._-]', '_', tenant_name)}{ext}"
+
+def _run_tenants(tenants, args, vuln_filter):
+
+    """
+    Reports on every tenant in a pool of processes and merges the part file
+    of each tenant into the output file in the order of the tenants file.
+    The output is merged into a .tmp file that is only renamed to the output
+    file when every tenant succeeded. Returns True when every tenant
+    succeeded.
+    """
+
+    pc_start = time.perf_counter()
+    report_file_name = args.sqlite_out if args.sqlite_out != None else args.csv_file_name
+    part_dir = tempfile.mkdtemp(prefix=".tenants-", dir=os.path.dirname(os.path.abspath(report_file_name)))
+
+    report_tmp_file_name = f"{report_file_name}.tmp"
+    if os.path.isfile(report_tmp_file_name):
+        os.remove(report_tmp_file_name)
+
+    report_headers = next(_gather_report_data([], []))
+    report_headers.append("Tenant")
+
+    if args.sqlite_out != None:
+        report_output_file = SqliteReportFile(report_tmp_file_name)
+        write = report_output_file.table_writer(report_headers)
+    else:
+        report_output_file = open(report_tmp_file_name, 'w')
+        write = csv.writer(report_output_file)
+        write.writerow(report_headers)
+
+    failed_tenants = []
+
+    try:
+
+        with report_output_file, ProcessPoolExecutor(max_workers=min(args.tenant_processes, len(tenants))) as executor:
+
+            LOG.info(f"Reporting on {len(tenants)} tenants with {min(args.tenant_processes, len(tenants))} processes...")
+            futures = [ executor.submit(_write_tenant_report, tenant, args, vuln_filter, os.path.join(part_dir, f"tenant-{idx}.csv"))
+                        for idx, tenant in enumerate(tenants) ]
+
+            # Merge in the order of the tenants file as each tenant completes
+            for tenant, future in zip(tenants, futures):
+                try:
+                    tenant_result = future.result()
+                except Exception as e:
+                    LOG.error(f"Report of tenant {tenant['name']} failed: {e}")
+                    failed_tenants.append(tenant["name"])
+                    continue
+
+                with open(tenant_result["part_file_name"], newline='') as part_file:
+                    write.writerows(csv.reader(part_file))
+                os.remove(tenant_result["part_file_name"])
+
+                LOG.info(f"Tenant {tenant['name']}: {tenant_result['rows']} rows from {tenant_result['scan_results']} scan results, HTTP Response Code 429 occurred {tenant_result['num_of_429']} times and 504 occurred {tenant_result['num_of_504']} times.")
+
+            #end - for tenant
+
+        if len(failed_tenants) == 0:
+            os.replace(report_tmp_file_name, report_file_name)
+
+    finally:
+        shutil.rmtree(part_dir, ignore_errors=True)
+        if os.path.isfile(report_tmp_file_name):
+            os.remove(report_tmp_file_name)
+
+    elapsed_seconds = time.perf_counter() - pc_start
+    LOG.info(f"Elapsed execution time: {timedelta(seconds=elapsed_seconds)}")
+
+    if len(failed_tenants) > 0:
+        LOG.error(f"No report was written since these tenants failed: {','.join(failed_tenants)}")
+        return False
+
+    LOG.info(f'Request for runtime scan results of {len(tenants)} tenants complete.')
+    return True
+
+def _write_tenant_report(tenant, args, vuln_filter, part_file_name):
+
+    """
+    Runs in a process of the tenant pool and writes the report rows of one
+    tenant to its part file. The module globals are set again so the tenant
+    has its own api client and cache whether the process was forked or not.
+    """
+
+    global api_client, runtime_filter, runtime_partitions, report_columns, stream_json, result_cache
+
+    tenant_start = time.perf_counter()
+    tenant_succeeded = False
+
+    if args.runtime_filter != None:
+        runtime_filter = args.runtime_filter
+    runtime_partitions = _get_runtime_partitions(args)
+    report_columns = _get_report_columns(args)
+    stream_json = args.stream_json
+    result_cache = None
+    if args.cache_dir != None:
+        result_cache = ResultCache(_tenant_file_name(os.path.join(args.cache_dir, "tenant"), tenant["name"]), args.cache_ttl_hours * 3600, int(args.cache_max_mb * 1024 * 1024))
+
+    api_client = SysdigApiClient(tenant["secure_url_authority"], tenant["api_token"], max_connections=args.workers, max_requests_per_second=args.max_requests_per_second)
+
+    try:
+
+        LOG.info(f"Tenant {tenant['name']}: retrieving the list of runtime workload scan results...")
+        scan_results_list = _get_runtime_workload_scan_results_list(workers=args.workers)
+        scan_results_list_with_vulns = _get_scan_results_list_with_vulnerabilties(scan_results_list, vuln_filter)
+        LOG.info(f"Tenant {tenant['name']}: found {len(scan_results_list_with_vulns)} of {len(scan_results_list)} scan results with vulnerabilities.")
+
+        images_vuln_rows = _get_images_vuln_rows(scan_results_list_with_vulns, vuln_filter, args.workers)
+        report_data = _gather_report_data(scan_results_list_with_vulns, images_vuln_rows)
+        next(report_data)
+
+        rows = 0
+        with open(part_file_name, 'w', newline='') as part_file:
+            write = csv.writer(part_file)
+            for report_row in report_data:
+                write.writerow((*report_row, tenant["name"]))
+                rows += 1
+
+        if result_cache != None:
+            result_cache.close()
+
+        tenant_succeeded = True
+
+    finally:
+        if args.metrics_out != None:
+            api_client.save_metrics(_tenant_file_name(args.metrics_out, tenant["name"]), args.metrics_format,
+                                    { "run_duration_seconds": time.perf_counter() - tenant_start, "run_succeeded": int(tenant_succeeded) },
+                                    { "tenant": tenant["name"] })
+
+    return {
+        "part_file_name": part_file_name,
+        "rows": rows,
+        "scan_results": len(scan_results_list),
+        "num_of_429": api_client.num_of_429,
+        "num_of_504": api_client.num_of_504,
+    }
+
+def _gather_report_data(scan_results_list_with_vulns, images_vuln_rows, workload_changes=None, previous_state=None):
+
+    """
+    Yields the report rows one image at a time so the report can be written
+    without holding it in memory. When workload changes are passed only the
+    added, changed and removed workloads are reported.
+    """
+
+    columns = report_columns
+    if columns == None:
+        columns = range(len(REPORT_HEADERS))
+
+    report_headers = [ REPORT_HEADERS[column_idx] for column_idx in columns ]
+    row_builder = ReportRowBuilder(columns)
+
+    if workload_changes != None:
+        report_headers.append("Change")
+
+    yield report_headers
+
+    image_workloads = _get_image_workloads(scan_results_list_with_vulns)
+
+    for image_key, result_id, image_vuln_rows in images_vuln_rows:
+
+        projected_rows = row_builder.project_image_rows(image_vuln_rows)
+
+        # An expired image retrieved again changed when its rows differ
+        refreshed = False
+        if workload_changes != None and previous_state != None:
+            previous_image = previous_state["images"].get(image_key)
+            if previous_image != None and previous_image["rows"] is not image_vuln_rows:
+                refreshed = json.dumps(image_vuln_rows) != json.dumps(previous_image["rows"])
+
+        for workload_key, (result, pod_count) in image_workloads[image_key].items():
+
+            change = None
+            if workload_changes != None:
+                change = workload_changes["workloads"][workload_key]
+                if change == "unchanged" and refreshed:
+                    change = "changed"
+                elif change == "unchanged":
+                    continue
+
+            yield from _build_workload_rows(result.result_id, result.workload, pod_count, projected_rows, row_builder, change)
+
+        #end - for workload
+
+    #end - for image
+
+    # Report the removed workloads with the rows of the previous run
+    if workload_changes != None:
+        for workload in workload_changes["removed"]:
+            previous_image = previous_state["images"].get(_load_image_key(workload["imageKey"]))
+            if previous_image != None:
+                workload_columns = tuple([ workload["scope"][field] for field in WORKLOAD_SCOPE_FIELDS ])
+                yield from _build_workload_rows(workload["resultId"], workload_columns, workload.get("podCount", 1), row_builder.project_image_rows(previous_image["rows"]), row_builder, "removed")
+
+def _get_image_workloads(scan_results_list_with_vulns):
+
+    """
+    Groups the workloads by the image they are running. There is a scan
+    result for every pod so identical workload containers are collapsed
+    into one entry with their pod count.
+    """
+
+    image_workloads = {}
 
-def _gather_report_data(scan_results_list_with_vulns, images_with_vulns_scan_results):
-
-    report_data = []
-
-    report_headers = []
-    report_headers.append("Vulnerability ID")
-    report_headers.append("Severity")
-    report_headers.append("Package name")
-    report_headers.append("Package version")
-    report_headers.append("Package type")
-    report_headers.append("Package path")
-    report_headers.append("Image")
-    report_headers.append("OS Name")
-    report_headers.append("CVSS version")
-    report_headers.append("CVSS score")
-    report_headers.append("CVSS vector")
-    report_headers.append("Vuln link")
-    report_headers.append("Vuln Publish date")
-    report_headers.append("Vuln Fix date")
-    report_headers.append("Fix version")
-    report_headers.append("Public Exploit")
-    report_headers.append("K8S cluster name")
-    report_headers.append("K8S namespace name")
-    report_headers.append("K8S workload type")
-    report_headers.append("K8S workload name")
-    report_headers.append("K8S container name")
-    report_headers.append("Image ID")
-    report_headers.append("K8S POD count")
-    report_headers.append("Package suggested fix")
-    report_headers.append("In use")
-    report_headers.append("Risk accepted")
-
-    report_data.append(report_headers)
-    
     for result in scan_results_list_with_vulns:
+        workloads = image_workloads.setdefault(result.image_key, {})
+        workload_key = result.workload
+        if workload_key in workloads:
+            workloads[workload_key][1] += 1
+        else:
+            workloads[workload_key] = [result, 1]
 
-        result_id = result["resultId"]
+    return image_workloads
 
-        kubernetes_cluster_name = result["scope"]["kubernetes.cluster.name"]
-        kubernetes_namespace_name = result["scope"]["kubernetes.namespace.name"]
-        kubernetes_pod_container_name = result["scope"]["kubernetes.pod.container.name"]
-        kubernetes_workload_name = result["scope"]["kubernetes.workload.name"]
-        kubernetes_workload_type = result["scope"]["kubernetes.workload.type"]
+def _build_workload_rows(result_id, workload_columns, pod_count, projected_rows, row_builder, change=None):
 
-        image_pull_string = images_with_vulns_scan_results[result_id]["result"]["metadata"].get("pullString")
+    """
+    Yields the report rows of a workload as tuples from the projected vuln
+    rows of its image.
+    """
 
-        #skip the result if the image pull string is blank
-        if image_pull_string == "":
-            LOG.warning(f"Found a blank image pull string for scan results id: {result_id}")
-            continue
+    #skip the result if the image pull string is blank
+    if projected_rows is None:
+        LOG.warning(f"Found a blank image pull string for scan results id: {result_id}")
+        return
 
-        image_id = images_with_vulns_scan_results[result_id]["result"]["metadata"]["imageId"]
-        base_os = images_with_vulns_scan_results[result_id]["result"]["metadata"]["baseOs"]
-        
-        result_details = images_with_vulns_scan_results[result_id]["result"]
+    yield from row_builder.build_rows(projected_rows, workload_columns, pod_count, change)
 
-        for package in result_details.get("packages", {}):
+def _get_images_vuln_rows(scan_results_list_with_vulns, vuln_filter, workers=1, previous_state=None, completed_image_keys=None, state_ttl_seconds=86400):
 
-            # skip packages without vulns
-            if package.get("vulns") is None:
-                continue
+    """
+    Yields (image key, result id, image vuln rows) for each unique image. The
+    rows of images that did not change since the previous run are taken from
+    its state until they are older than the ttl, only the changed and expired
+    images are retrieved. Images completed by a resumed run are skipped.
+    """
+
+    image_keys = None
+
+    if completed_image_keys:
+        image_keys = set()
+        for result in scan_results_list_with_vulns:
+            image_keys.add(result.image_key)
+        image_keys -= completed_image_keys
 
-            package_type = package.get("type","")
-            package_name = package.get("name","")
-            package_version = package.get("version","")
-            package_path = package.get("path","")
-            package_suggested_fix = package.get("suggestedFix","")
-            package_in_use = package.get("inUse","")
+    if previous_state != None:
 
-            for vuln in package.get("vulns",{}):
+        # An image changed when none of its workloads use the result id
+        # the previous run retrieved for it
+        image_result_ids = {}
+        for result in scan_results_list_with_vulns:
+            image_result_ids.setdefault(result.image_key, set()).add(result.result_id)
 
-                vuln_name = vuln.get("name","")
-                vuln_severity = vuln.get("severity", { "value": "", "sourceName" : "" })
-                vuln_severity_value = vuln_severity["value"]
+        if image_keys == None:
+            image_keys = set(image_result_ids)
 
-                #KAA
-                if vuln_severity_value not in ["Critical","High"]:
-                    #print(f"vuln_severity_value := {vuln_severity_value}")
+        # The risk accept status of the rows is refreshed once they expire,
+        # a state without the fetch time is always expired
+        now = time.time()
+        expired_count = 0
+
+        for image_key, result_ids in image_result_ids.items():
+            previous_image = previous_state["images"].get(image_key)
+            if previous_image != None and previous_image["resultId"] in result_ids:
+                if now - previous_image.get("fetchedAt", 0) > state_ttl_seconds:
+                    expired_count += 1
                     continue
+                yield image_key, previous_image["resultId"], previous_image["rows"]
+                image_keys.discard(image_key)
 
-                vuln_severity_source = vuln_severity["sourceName"]
-                vuln_cvss_score = vuln.get("cvssScore", {'value': {'version': '', 'score': '', 'vector': ''}, 'sourceName': ''})
-                vuln_cvss_score_value = vuln_cvss_score.get("value",{'version': '', 'score': '', 'vector': ''})
-                vuln_cvss_score_value_version = vuln_cvss_score_value["version"]
-                vuln_cvss_score_value_score = vuln_cvss_score_value["score"]
-                vuln_cvss_score_value_vector = vuln_cvss_score_value["vector"]
-                vuln_cvss_score_source = vuln_cvss_score["sourceName"]
-                vuln_disclosure_date = vuln["disclosureDate"]
-                vuln_solution_date = vuln.get("solutionDate","")
-                vuln_exploitable = vuln["exploitable"]
-                vuln_fixed_in_version = vuln.get("fixedInVersion","")
-                vuln_risk_accepted = _is_risk_accepted(result_details, vuln, package)
-
-                report_row = []
-                report_row.append(vuln_name)
-                report_row.append(vuln_severity_value)
-                report_row.append(package_name)
-                report_row.append(package_version)
-                report_row.append(package_type)
-
-                # we don't show package path for os packages
-                # in the runtime report
-                if package_type == "os":
-                    report_row.append('')
-                else:
-                    report_row.append(package_path)
-                report_row.append(image_pull_string)
-                report_row.append(base_os)
-                report_row.append(vuln_cvss_score_value_version)
-                report_row.append(vuln_cvss_score_value_score)
-                report_row.append(vuln_cvss_score_value_vector)
-                #report_row.append('TODO') ### "Vuln link"
-                report_row.append('') ### "Vuln link"
-                report_row.append(vuln_disclosure_date)
-                report_row.append(vuln_solution_date)
-                report_row.append(vuln_fixed_in_version)
-                report_row.append(vuln_exploitable)
-                report_row.append(kubernetes_cluster_name)
-                report_row.append(kubernetes_namespace_name)
-                report_row.append(kubernetes_workload_type)
-                report_row.append(kubernetes_workload_name)
-                report_row.append(kubernetes_pod_container_name)
-                report_row.append(image_id)
+        LOG.info(f"Reusing {len(image_result_ids) - len(image_keys)} unchanged images from the previous run, {expired_count} expired images are retrieved again.")
+
+    yield from _get_image_scan_results(scan_results_list_with_vulns, vuln_filter, workers, image_keys)
+
+def _checkpoint_images(checkpoint, report_output_file, images_vuln_rows):
+
+    """
+    The next image is only requested once every row of the previous image
+    has been written so that is when the previous image is checkpointed.
+    """
+
+    previous_image_key = None
+
+    for image_key, result_id, image_vuln_rows in images_vuln_rows:
+        if previous_image_key != None:
+            report_output_file.flush()
+            checkpoint.add_image(previous_image_key, report_output_file.tell())
+        previous_image_key = image_key
+        yield image_key, result_id, image_vuln_rows
+
+    if previous_image_key != None:
+        report_output_file.flush()
+        checkpoint.add_image(previous_image_key, report_output_file.tell())
+
+def _gather_image_vuln_rows(result_details, vuln_filter, package_vuln_rows=None):
+
+    """
+    Builds the vuln rows of an image. A streamed scan result passes the
+    package vuln rows gathered while its packages were parsed since the
+    image metadata and accepts may follow the packages.
+    """
+
+    if package_vuln_rows is None:
+        package_vuln_rows = []
+        for package in result_details.get("packages", {}):
+            package_vuln_rows.extend(_gather_package_vuln_rows(package, vuln_filter))
+
+    image_vuln_rows = []
+
+    image_pull_string = result_details["metadata"].get("pullString")
+
+    # a blank image pull string is reported by the caller
+    if image_pull_string == "":
+        return None
+
+    image_id = result_details["metadata"]["imageId"]
+    base_os = result_details["metadata"]["baseOs"]
+    risk_accept_index = _get_risk_accept_index(result_details)
+
+    for vuln_row_head, vuln_row_tail, vuln_accepted_risks in package_vuln_rows:
+
+        vuln_row_head[6] = image_pull_string
+        vuln_row_head[7] = base_os
+        vuln_row_tail.append(_is_risk_accepted(risk_accept_index, vuln_accepted_risks)) ### "Risk accepted"
+
+        image_vuln_rows.append((image_id, tuple(vuln_row_head), tuple(vuln_row_tail)))
+
+    return image_vuln_rows
+
+def _gather_package_vuln_rows(package, vuln_filter):
+
+    """
+    Builds the vuln rows of a package, the image columns and the risk
+    accepted column are filled in by _gather_image_vuln_rows.
+    """
+
+    package_vuln_rows = []
+
+    # skip packages without vulns
+    if package.get("vulns") is None:
+        return package_vuln_rows
+
+    # skip packages not in use when only reporting in use vulns
+    if vuln_filter["in_use_only"] and package.get("inUse") != True:
+        return package_vuln_rows
+
+    vuln_severity_values = [ severity.capitalize() for severity in vuln_filter["severities"] ]
+
+    package_type = package.get("type","")
+    package_name = package.get("name","")
+    package_version = package.get("version","")
+    package_path = package.get("path","")
+    package_suggested_fix = package.get("suggestedFix","")
+    package_in_use = package.get("inUse","")
+
+    for vuln in package.get("vulns",{}):
+
+        vuln_name = vuln.get("name","")
+        vuln_severity = vuln.get("severity", { "value": "", "sourceName" : "" })
+        vuln_severity_value = vuln_severity["value"]
+
+        #KAA
+        if vuln_severity_value not in vuln_severity_values:
+            #print(f"vuln_severity_value := {vuln_severity_value}")
+            continue
+
+        if vuln_filter["fixable_only"] and vuln.get("fixedInVersion","") in ["", None]:
+            continue
+
+        if vuln_filter["exploitable_only"] and vuln.get("exploitable") != True:
+            continue
+
+        vuln_severity_source = vuln_severity["sourceName"]
+        vuln_cvss_score = vuln.get("cvssScore", {'value': {'version': '', 'score': '', 'vector': ''}, 'sourceName': ''})
+        vuln_cvss_score_value = vuln_cvss_score.get("value",{'version': '', 'score': '', 'vector': ''})
+        vuln_cvss_score_value_version = vuln_cvss_score_value["version"]
+        vuln_cvss_score_value_score = vuln_cvss_score_value["score"]
+        vuln_cvss_score_value_vector = vuln_cvss_score_value["vector"]
+        vuln_cvss_score_source = vuln_cvss_score["sourceName"]
+        vuln_disclosure_date = vuln["disclosureDate"]
+        vuln_solution_date = vuln.get("solutionDate","")
+        vuln_exploitable = vuln["exploitable"]
+        vuln_fixed_in_version = vuln.get("fixedInVersion","")
+
+        # columns before the kubernetes columns
+        vuln_row_head = []
+        vuln_row_head.append(vuln_name)
+        vuln_row_head.append(vuln_severity_value)
+        vuln_row_head.append(package_name)
+        vuln_row_head.append(package_version)
+        vuln_row_head.append(package_type)
+
+        # we don't show package path for os packages
+        # in the runtime report
+        if package_type == "os":
+            vuln_row_head.append('')
+        else:
+            vuln_row_head.append(package_path)
+        vuln_row_head.append('') ### "Image"
+        vuln_row_head.append('') ### "OS Name"
+        vuln_row_head.append(vuln_cvss_score_value_version)
+        vuln_row_head.append(vuln_cvss_score_value_score)
+        vuln_row_head.append(vuln_cvss_score_value_vector)
+        #vuln_row_head.append('TODO') ### "Vuln link"
+        vuln_row_head.append('') ### "Vuln link"
+        vuln_row_head.append(vuln_disclosure_date)
+        vuln_row_head.append(vuln_solution_date)
+        vuln_row_head.append(vuln_fixed_in_version)
+        vuln_row_head.append(vuln_exploitable)
+
+        # columns after the pod count column
+        vuln_row_tail = []
+        vuln_row_tail.append(package_suggested_fix)
+        vuln_row_tail.append(package_in_use)
+
+        package_vuln_rows.append((vuln_row_head, vuln_row_tail, vuln.get("acceptedRisks",[])))
+
+    #end - for vuln
+
+    return package_vuln_rows
+
+def _get_workload_changes(scan_results_list_with_vulns, previous_state):
+
+    """
+    Compares the workloads with the previous run. Workloads are added when
+    they did not exist, changed when their result id, image scan or pod
+    count changed and removed when they no longer exist.
+    """
+
+    workload_changes = { "workloads": {}, "removed": [], "counts": { "added": 0, "changed": 0, "unchanged": 0 } }
+    previous_workloads = previous_state["workloads"]
+
+    image_result_ids = {}
+    pod_counts = {}
+    for result in scan_results_list_with_vulns:
+        image_result_ids.setdefault(result.image_key, set()).add(result.result_id)
+        workload_key = result.workload
+        pod_counts[workload_key] = pod_counts.get(workload_key, 0) + 1
+
+    for result in scan_results_list_with_vulns:
+
+        workload_key = result.workload
+        if workload_key in workload_changes["workloads"]:
+            continue
+
+        image_key = result.image_key
+        previous_workload = previous_workloads.get(workload_key)
+        previous_image = previous_state["images"].get(image_key)
+
+        if previous_workload == None:
+            change = "added"
+        elif previous_workload["resultId"] != result.result_id or previous_image == None or previous_image["resultId"] not in image_result_ids[image_key]:
+            change = "changed"
+        elif previous_workload.get("podCount", 1) != pod_counts[workload_key]:
+            change = "changed"
+        else:
+            change = "unchanged"
+
+        workload_changes["workloads"][workload_key] = change
+        workload_changes["counts"][change] += 1
 
-                # defaulting for now
-                #report_row.append('TODO') ### "K8S POD count"
-                report_row.append('1') ### "K8S POD count"
+    for workload_key, previous_workload in previous_workloads.items():
+        if workload_key not in workload_changes["workloads"]:
+            workload_changes["removed"].append(previous_workload)
 
-                report_row.append(package_suggested_fix)
-                report_row.append(package_in_use)
+    return workload_changes
 
-                report_row.append(vuln_risk_accepted) ### "Risk accepted")
+def _load_state(state_file):
 
-                report_data.append(report_row)
+    """
+    The state file is gzipped json lines, the first line holds the workloads
+    and each following line holds the vuln rows of one image.
+    """
 
-            #end - for vuln
+    previous_state = { "filter": None, "workloads": {}, "images": {} }
 
-        #end - for package
+    with gzip.open(state_file, "rt") as state_input_file:
+        for line_number, line in enumerate(state_input_file):
+            entry = json.loads(line)
+            if line_number == 0:
+                previous_state["filter"] = entry.get("filter")
+                # the workloads are keyed by their scope values like the
+                # workload tuple of the scan results
+                previous_state["workloads"] = { tuple([ workload["scope"].get(field) for field in WORKLOAD_SCOPE_FIELDS ]): workload
+                                                for workload in entry["workloads"].values() }
+            else:
+                previous_state["images"][_load_image_key(entry["imageKey"])] = entry
 
-    return report_data 
+    return previous_state
 
-def _is_risk_accepted(result, vuln, package):
+def _save_state(state_output_file, scan_results_list_with_vulns, vuln_filter, images_vuln_rows, previous_state=None):
 
-    risk_accepted = False
+    workloads = {}
+    for result in scan_results_list_with_vulns:
+        workload_key = result.workload
+        if workload_key in workloads:
+            workloads[workload_key]["podCount"] += 1
+        else:
+            workloads[workload_key] = {
+                "resultId": result.result_id,
+                "imageKey": result.image_key,
+                "scope": dict(zip(WORKLOAD_SCOPE_FIELDS, result.workload)),
+                "podCount": 1,
+            }
+
+    # json object keys are strings so the workload tuples are serialised
+    workloads = { json.dumps(workload_key): workload for workload_key, workload in workloads.items() }
+    state_output_file.write(json.dumps({ "filter": vuln_filter, "workloads": workloads }) + "\n")
+
+    # Reused images keep the time their rows were retrieved
+    for image_key, result_id, image_vuln_rows in images_vuln_rows:
+        fetched_at = time.time()
+        if previous_state != None:
+            previous_image = previous_state["images"].get(image_key)
+            if previous_image != None and previous_image["rows"] is image_vuln_rows:
+                fetched_at = previous_image.get("fetchedAt", fetched_at)
+        state_output_file.write(json.dumps({ "imageKey": image_key, "resultId": result_id, "fetchedAt": fetched_at, "rows": image_vuln_rows }) + "\n")
+        yield image_key, result_id, image_vuln_rows
+
+def _get_image_key(result):
+
+    # Workloads running the same image share the same scan result details so
+    # the image id and pull string identify it. The pull string is part of
+    # the key since one image id can run under several tags or registries,
+    # and the Image column and the image accepts belong to the pull string.
+    image_id = result.get("resourceId") or ""
+    pull_string = result.get("mainAssetName") or ""
+    if image_id == "" and pull_string == "":
+        pull_string = result["resultId"]
+
+    return (image_id, pull_string)
+
+def _load_image_key(image_key):
+
+    # json turns the key tuple into a list, the image keys of older state
+    # files are strings that no longer match and are retrieved again
+    if isinstance(image_key, list):
+        return tuple(image_key)
+
+    return image_key
+
+def _get_risk_accept_index(result):
+
+    """
+    The image accept status and the active accept definitions are the same
+    for every vuln of a result so they are only looked up once per result.
+    """
 
     # * the defs
-    risk_accept_defs = result.get("riskAcceptanceDefinitions")
+    risk_accept_defs = result.get("riskAcceptanceDefinitions") or []
 
     #* points back to accept defs
 
     #KAA-TODO: Double check with accept id
 
+    active_accept_def_idxs = set()
+    for accept_def_idx, accept_def in enumerate(risk_accept_defs):
+        if accept_def["status"] == "active":
+            active_accept_def_idxs.add(accept_def_idx)
+
     # Image Risk Accepts
     # Set all vulns to "accepted" for image risk accepts
-
-    # Process image accepts
-    asset_accepted_risks = result.get("assetAcceptedRisks",[])
-    for image_accept in asset_accepted_risks:
-        accept_def_idx = image_accept["index"]
-        accept_def = risk_accept_defs[accept_def_idx]
-        status = accept_def["status"]
-        if status == "active":
-            risk_accepted = True
+    image_risk_accepted = False
+    for image_accept in result.get("assetAcceptedRisks",[]):
+        if image_accept["index"] in active_accept_def_idxs:
+            image_risk_accepted = True
             break
 
+    return image_risk_accepted, active_accept_def_idxs
+
+def _is_risk_accepted(risk_accept_index, vuln_accepted_risks):
+
+    image_risk_accepted, active_accept_def_idxs = risk_accept_index
+
+    if image_risk_accepted:
+        return True
+
     # Process vuln accepts
-    if risk_accepted == False:
-        vuln_accepted_risks = vuln.get("acceptedRisks",[])
-        for vuln_accept in vuln_accepted_risks:
-            accept_def_idx = vuln_accept["index"]
-            accept_def = risk_accept_defs[accept_def_idx]
-            status = accept_def["status"]
-            if status == "active":
-                risk_accepted = True
-                break
+    for vuln_accept in vuln_accepted_risks:
+        if vuln_accept["index"] in active_accept_def_idxs:
+            return True
 
-    return risk_accepted
+    return False
 
-def _get_scan_results_list_with_vulnerabilties(scan_results_list):
+def _get_scan_results_list_with_vulnerabilties(scan_results_list, vuln_filter):
 
     scan_results_list_with_vulns = []
 
     for result in scan_results_list:
 
-        total_vulns = 0
-        total_vulns += result["vulnTotalBySeverity"]["critical"]
-        total_vulns += result["vulnTotalBySeverity"]["high"]
+        # Only count the vulns of running packages when they are known
+        vuln_totals = result.vuln_totals
+        if vuln_filter["in_use_only"] and result.running_vuln_totals != None:
+            vuln_totals = result.running_vuln_totals
 
-        # Hardcoded to only include image results critical and high vulns
-        #total_vulns += result["vulnTotalBySeverity"]["low"]
-        #total_vulns += result["vulnTotalBySeverity"]["medium"]
-        #total_vulns += result["vulnTotalBySeverity"]["negligible"]
+        # Only include image results with vulns of the reported severities,
+        # fixable and exploitable vulns are not counted by the results list
+        total_vulns = 0
+        for severity in vuln_filter["severities"]:
+            total_vulns += vuln_totals[VULN_SEVERITIES.index(severity)]
 
         if total_vulns > 0:
             scan_results_list_with_vulns.append(result)
@@ -364,113 +1582,271 @@ def _get_scan_results_list_with_vulnerabilties(scan_results_list):
 
     return scan_results_list_with_vulns
 
-def _get_runtime_workload_scan_results_list():
+def _get_runtime_workload_scan_results_list(checkpoint=None, workers=1):
 
     limit=1000
     cursor=""
-    json_response=None
     runtime_workload_scan_results = []
 
-    while True:
-        api_path = "secure/vulnerability/v1beta1/runtime-results"
-        api_url = f"https://{secure_url_authority}/{api_path}?cursor={cursor}&filter=asset.type+%3D+'workload'&limit={limit}"
-        response_data = _get_data_from_http_request(api_url)
-        json_response = json.loads(response_data)
+    # Continue from the pages saved by a previous run
+    if checkpoint != None:
+        runtime_workload_scan_results = checkpoint.scan_results
+        cursor = checkpoint.cursor
+        if checkpoint.listed:
+            return runtime_workload_scan_results
+
+    api_path = "secure/vulnerability/v1beta1/runtime-results"
+
+    # A resumed run continues the unfinished listing from its cursor
+    if runtime_partitions != None and cursor == "":
+        return _get_partitioned_scan_results_list(api_path, limit, workers, checkpoint)
+
+    query = f"filter={_get_runtime_results_filter()}"
+
+    for json_response in api_client.paginate(api_path, query, limit, cursor):
 
         LOG.debug(f"Found {len(json_response['data'])} entries in the json_response")
-        
-        runtime_workload_scan_results.extend(json_response["data"])
 
-        if "next" in json_response["page"]:
-            cursor = json_response["page"]["next"]
-        else:
-            break
+        runtime_workload_scan_results.extend([ WorkloadResult(result) for result in json_response["data"] ])
+
+        if checkpoint != None:
+            checkpoint.add_page(json_response["data"], json_response["page"].get("next"))
 
-    #end while
+    #end for
 
     return runtime_workload_scan_results
 
-def _get_image_scan_results(scan_results_list_with_vulns):
+def _get_partitioned_scan_results_list(api_path, limit, workers=1, checkpoint=None):
 
-    api_path = "secure/vulnerability/v1beta1/results"
-    api_url = f"https://{secure_url_authority}/{api_path}"
-    image_scan_results={}
-    spinner = ["|", "/", "-", "\\" ]
-    spinner_idx = 0
-    spinner_end = 3
-    num_of_results = len(scan_results_list_with_vulns)
-    num_of_requests = 0
-    for result in scan_results_list_with_vulns:
+    """
+    Lists each partition of the runtime results with its own cursor, the
+    partitions are paginated concurrently. A result listed by an earlier
+    partition is dropped from the later ones so overlapping partitions are
+    only reported once, the results of one partition are kept as listed.
+    """
 
-        print(spinner[spinner_idx],end="\r")
-        num_of_requests += 1
-        print(f"{spinner[spinner_idx]} Retrieving {num_of_requests} of {num_of_results}...",end="\r")
-        if spinner_idx == spinner_end:
-            spinner_idx = 0
-        else:
-            spinner_idx += 1
+    partition_field, partition_values = runtime_partitions
 
-        resultId = result["resultId"]
-        if resultId not in image_scan_results.keys():
-            response_data = _get_data_from_http_request(f"{api_url}/{resultId}")
-            json_response = json.loads(response_data)
-            image_scan_results[resultId]=json_response
+    # One partition per value and one for every other value of the field
+    partition_expressions = [ f"{partition_field} = '{value}'" for value in partition_values ]
+    partition_expressions.append(" and ".join([ f"{partition_field} != '{value}'" for value in partition_values ]))
 
-    return image_scan_results
+    def list_partition(partition_expression):
+        partition_results = []
+        query = f"filter={_get_runtime_results_filter(partition_expression)}"
+        for json_response in api_client.paginate(api_path, query, limit):
+            partition_results.extend([ WorkloadResult(result) for result in json_response["data"] ])
+        return partition_results
 
-def _get_data_from_http_request(url):
+    pc_start = time.perf_counter()
 
-    try:
+    with ThreadPoolExecutor(max_workers=min(workers, len(partition_expressions))) as executor:
+        partitions_results = list(executor.map(list_partition, partition_expressions))
 
-        global num_of_429
-        global num_of_504
-        response_data = None
+    runtime_workload_scan_results = []
+    listed_keys = set()
+    for partition_results in partitions_results:
+        partition_keys = set()
+        for result in partition_results:
+            result_key = (result.result_id, result.workload)
+            if result_key in listed_keys:
+                continue
+            partition_keys.add(result_key)
+            runtime_workload_scan_results.append(result)
+        listed_keys.update(partition_keys)
 
-        while True:
+    LOG.info(f"Listed {len(partition_expressions)} partitions by {partition_field} in {time.perf_counter() - pc_start:0.2f} seconds, {sum(map(len, partitions_results)) - len(runtime_workload_scan_results)} duplicate results dropped.")
 
-            LOG.debug(f"Sending http request to: {url}")
+    if checkpoint != None:
+        checkpoint.add_listed_results(runtime_workload_scan_results)
 
-            response = http_client.request(method="GET", url=url, redirect=True)
-            response_data = response.data.decode()
+    return runtime_workload_scan_results
 
-            LOG.debug(f"Response status: {response.status}")
+def _get_runtime_partitions(args):
 
-            if response.status == 200:
-                #LOG.debug(f"Response data: {response_data}")
-                break
+    if args.partitions == None:
+        return None
 
-            elif response.status in [ 429, 504 ]:
+    partition_values = [ value.strip() for value in args.partitions.split(",") if value.strip() != "" ]
+    if len(partition_values) == 0:
+        return None
 
-                if response.status == 429:
-                    message = "API throttling"
-                    num_of_429 += 1
-                elif response.status == 504:
-                    message = "Gateway Timeout"
-                    num_of_504 += 1
+    # The values are put in quoted filter literals, a quote would end the
+    # literal and change what the partitions and their complement match
+    for value in partition_values:
+        if "'" in value:
+            LOG.error(f"ERROR: The partition value {value} cannot contain a quote!")
+            raise SystemExit(-1)
 
-                LOG.debug(f"Response data: {response_data}")
-                LOG.debug(f"Sleeping 60 seconds due to {message}...")
+    return args.partition_by, partition_values
 
-                for interval in range(1,60):
-                   print(f"Sleeping {60-interval} seconds due to {message}...", end="\r")
-                   time.sleep(1)
+def _get_report_columns(args):
 
-                # Extra space to clear earlier message
-                print( "Retrying request...                                    ", end="\r")
+    if args.columns == None:
+        return None
 
-                LOG.debug(f"Retrying request...")
+    # The sqlite column names are accepted as well
+    column_idxs = { header: column_idx for column_idx, header in enumerate(REPORT_HEADERS) }
+    column_idxs.update({ header.replace(" ", "_"): column_idx for column_idx, header in enumerate(REPORT_HEADERS) })
 
+    columns = []
+    for column in args.columns.split(","):
+        column = column.strip()
+        if column == "":
+            continue
+        if column not in column_idxs:
+            LOG.error(f"ERROR: Unknown report column {column}, use one or more of: {','.join(REPORT_HEADERS)}!")
+            raise SystemExit(-1)
+        if column_idxs[column] in columns:
+            LOG.error(f"ERROR: The report column {column} is passed more than once!")
+            raise SystemExit(-1)
+        columns.append(column_idxs[column])
+
+    if len(columns) == 0:
+        return None
+
+    # The vm-metrics report queries these columns of the vulns table
+    if args.sqlite_out != None:
+        missing_headers = [ header for header in SQLITE_REQUIRED_HEADERS if REPORT_HEADERS.index(header) not in columns ]
+        if len(missing_headers) > 0:
+            LOG.error(f"ERROR: The --sqlite_out report requires the columns: {','.join(missing_headers)}!")
+            raise SystemExit(-1)
+
+    return columns
+
+def _get_runtime_results_filter(partition_expression=None):
+
+    # Only workloads are reported, the passed filter narrows them further
+    filter_expression = "asset.type = 'workload'"
+    if runtime_filter != "":
+        filter_expression += f" and ({runtime_filter})"
+    if partition_expression != None:
+        filter_expression += f" and ({partition_expression})"
+
+    return urllib.parse.quote_plus(filter_expression, safe="'")
+
+def _get_image_scan_results(scan_results_list_with_vulns, vuln_filter, workers=1, image_keys=None):
+
+    """
+    Yields (image key, result id, image vuln rows) for each unique image in
+    the order the images first appear in the scan results list, limited to
+    the passed image keys if any. Only a bounded number of requests are in
+    flight so memory does not grow with the fleet size.
+    """
+
+    api_path = "secure/vulnerability/v1beta1/results"
+    spinner = ["|", "/", "-", "\\" ]
+    spinner_idx = 0
+    spinner_end = 3
+    num_of_requests = 0
+
+    # Only request one result id for each image
+    requested_image_keys = set()
+    result_ids = []
+    for result in scan_results_list_with_vulns:
+        image_key = result.image_key
+        if image_keys != None and image_key not in image_keys:
+            continue
+        if image_key not in requested_image_keys:
+            requested_image_keys.add(image_key)
+            result_ids.append((image_key, result.result_id))
+    num_of_results = len(result_ids)
+
+    pc_start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+
+        pending = deque()
+        result_ids_iter = iter(result_ids)
+
+        for image_key, resultId in itertools.islice(result_ids_iter, workers * 2):
+            pending.append((image_key, resultId, executor.submit(_get_result_vuln_rows, f"{api_path}/{resultId}", resultId, vuln_filter)))
+
+        while pending:
+
+            image_key, result_id, future = pending.popleft()
+            image_vuln_rows = future.result()
+
+            for next_image_key, resultId in itertools.islice(result_ids_iter, 1):
+                pending.append((next_image_key, resultId, executor.submit(_get_result_vuln_rows, f"{api_path}/{resultId}", resultId, vuln_filter)))
+
+            num_of_requests += 1
+            print(f"{spinner[spinner_idx]} Retrieving {num_of_requests} of {num_of_results}...",end="\r")
+            if spinner_idx == spinner_end:
+                spinner_idx = 0
             else:
-                raise UnexpectedHTTPResponse(
-                    f"Unexpected HTTP response status: {response.status}"
-                )
+                spinner_idx += 1
 
-        return response_data
+            yield image_key, result_id, image_vuln_rows
 
-    except Exception as e:
-        LOG.critical(e)
-        LOG.critical(f"Error while requesting url: {url}")
-        raise SystemExit(-1)
+    pc_end = time.perf_counter()
+    elapsed_seconds = pc_end - pc_start
+    throughput = num_of_results / elapsed_seconds if elapsed_seconds > 0 else 0
+    LOG.info(f"Retrieved {num_of_results} scan results for unique images with {workers} worker(s) in {elapsed_seconds:0.2f} seconds ({throughput:0.2f} results/second).")
+
+def _get_result_vuln_rows(api_path, result_id, vuln_filter):
+
+    # Use the cached scan result details when there are any
+    if result_cache != None:
+        response_data = result_cache.get(result_id)
+        if response_data != None:
+            return _gather_image_vuln_rows(json.loads(response_data)["result"], vuln_filter)
+
+    if not stream_json:
+        response_data = api_client.get(api_path)
+        if result_cache != None:
+            result_cache.put(result_id, response_data)
+        return _gather_image_vuln_rows(api_client.metrics.decode_json("GET", api_client.get_url(api_path), response_data)["result"], vuln_filter)
+
+    response = api_client.get_stream(api_path)
+    try:
+        if result_cache != None:
+            response_reader = CompressingReader(response)
+            image_vuln_rows = _stream_image_vuln_rows(response_reader, vuln_filter)
+            result_cache.put_compressed(result_id, response_reader.compressed_data())
+        else:
+            image_vuln_rows = _stream_image_vuln_rows(response, vuln_filter)
+    finally:
+        response.release_conn()
+
+    return image_vuln_rows
+
+def _stream_image_vuln_rows(response_file, vuln_filter):
+
+    """
+    Parses a scan result while it is read so only one package is held in
+    memory at a time, every other result field is kept whole since they are
+    small compared to the packages.
+    """
+
+    result_details = {}
+    package_vuln_rows = []
+    result_key = None
+    builder = None
+
+    for prefix, event, value in ijson.parse(response_file, use_float=True):
+
+        if prefix == "result" and event in ["map_key", "end_map"]:
+            if result_key not in [None, "packages"]:
+                result_details[result_key] = builder.value
+            result_key = value if event == "map_key" else None
+            builder = None
+            if result_key not in [None, "packages"]:
+                builder = ijson.ObjectBuilder()
+
+        elif result_key == "packages":
+            if prefix == "result.packages.item" and event == "start_map":
+                builder = ijson.ObjectBuilder()
+            if builder != None:
+                builder.event(event, value)
+                if prefix == "result.packages.item" and event == "end_map":
+                    package_vuln_rows.extend(_gather_package_vuln_rows(builder.value, vuln_filter))
+                    builder = None
+
+        elif builder != None:
+            builder.event(event, value)
+
+    return _gather_image_vuln_rows(result_details, vuln_filter, package_vuln_rows)
 
 if __name__ == "__main__":
     sys.exit(main())
@@ -0,0 +1,479 @@
+"""
+  Shared client for the Sysdig Secure API used by the scripts in this
+  repository. It owns the connection pool, keep-alive, timeouts, retries,
+  rate limiting, pagination, authentication and request metrics so every
+  script behaves the same way.
+
+  The scripts are run directly from their folders so they add the
+  repository root to the module search path before importing it:
+
+     sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+     from sysdig_api_client import SysdigApiClient
+
+  Throttled (429) and gateway timeout (504) responses are retried until
+  they succeed, the rate limiter backs off every request in the meantime.
+  Connection errors are retried 3 times by urllib3. Any other status raises
+  UnexpectedHTTPResponse.
+
+  Compressed responses are requested with Accept-Encoding, the large json
+  results compress 10-20x. The bodies are decompressed while they are read
+  so a streamed response is never held whole, compressed or not.
+
+  Use paginate_prefetch to list a cursor paginated endpoint with the next
+  page downloaded while the current one is handled.
+
+  Use delete_all to delete many objects concurrently, a 404 counts as
+  already deleted and the progress is logged with an estimate of the time
+  left.
+"""
+
+import logging
+import urllib3
+import urllib.parse
+import json
+import re
+import os
+import sys
+import time
+import random
+import threading
+from datetime import timedelta
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
+
+LOG = logging.getLogger(__name__)
+logging.getLogger("urllib3").setLevel(logging.CRITICAL)
+
+# Define custom exceptions
+class UnexpectedHTTPResponse(Exception):
+    """Used when recieving an unexpected HTTP response"""
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+class RateLimiter:
+    """
+    Token bucket shared by every request. The request rate is lowered when
+    the API throttles or reports that few requests remain and slowly raised
+    again while requests succeed.
+    """
+
+    def __init__(self, max_rate=20.0, min_rate=0.5, max_backoff=60.0):
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate)
+        self.max_backoff = max_backoff
+        self.rate = max_rate
+        self.tokens = 1.0
+        self.last_refill = time.monotonic()
+        self.resume_at = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Wait for a token and for any backoff in progress to end"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(max(self.rate, 1.0), self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if now >= self.resume_at and self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                wait = max(self.resume_at - now, (1.0 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def success(self, headers):
+        """Raise the rate, or lower it when the remaining quota is running out"""
+        with self.lock:
+            remaining = headers.get("X-RateLimit-Remaining")
+            limit = headers.get("X-RateLimit-Limit")
+            if remaining and limit and remaining.isdigit() and limit.isdigit() and int(remaining) < int(limit) * 0.1:
+                self.rate = max(self.min_rate, self.rate * 0.75)
+            else:
+                self.rate = min(self.max_rate, self.rate + 0.1)
+
+    def backoff(self, attempt, retry_after=None, throttled=True):
+        """Pause all requests and return the number of seconds to wait"""
+        delay = _parse_retry_after(retry_after)
+        if delay is None:
+            delay = min(self.max_backoff, 2 ** attempt)
+            delay = delay / 2 + random.uniform(0, delay / 2)
+        with self.lock:
+            now = time.monotonic()
+            # concurrent requests throttled during the same backoff only
+            # lower the rate once
+            if throttled and now >= self.resume_at:
+                self.rate = max(self.min_rate, self.rate / 2)
+            self.resume_at = max(self.resume_at, now + delay)
+        return delay
+
+def _parse_retry_after(retry_after):
+
+    if retry_after is None:
+        return None
+
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+
+    try:
+        retry_at = parsedate_to_datetime(retry_after)
+        return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class RequestMetrics:
+    """
+    Request counts, latency histogram, bytes received, retries, backoff time
+    and json decode time for each endpoint. Bytes received are counted as
+    sent over the wire, bytes decoded after any decompression. The endpoint is the request
+    method and url path with the ids replaced so that every request for the
+    same kind of object is counted together.
+    """
+
+    LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+
+    def __init__(self):
+        self.endpoints = {}
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def _get_endpoint(self, method, url):
+        path = urllib.parse.urlsplit(url).path
+        path = re.sub(r"/(?!v\d+(?:beta\d+)?(?:/|$))[^/]*\d[^/]*", "/{id}", path)
+        endpoint_name = f"{method} {path}"
+        endpoint = self.endpoints.get(endpoint_name)
+        if endpoint is None:
+            endpoint = {
+                "requests": 0,
+                "status_codes": {},
+                "latency_buckets": [0] * len(self.LATENCY_BUCKETS),
+                "latency_seconds": 0.0,
+                "bytes_received": 0,
+                "bytes_decoded": 0,
+                "retries": 0,
+                "backoff_seconds": 0.0,
+                "rate_limit_wait_seconds": 0.0,
+                "json_decode_seconds": 0.0,
+            }
+            self.endpoints[endpoint_name] = endpoint
+        return endpoint
+
+    def add_request(self, method, url, status, latency, bytes_received, rate_limit_wait, bytes_decoded=0):
+        with self.lock:
+            endpoint = self._get_endpoint(method, url)
+            endpoint["requests"] += 1
+            endpoint["status_codes"][str(status)] = endpoint["status_codes"].get(str(status), 0) + 1
+            for idx, bucket in enumerate(self.LATENCY_BUCKETS):
+                if latency <= bucket:
+                    endpoint["latency_buckets"][idx] += 1
+            endpoint["latency_seconds"] += latency
+            endpoint["bytes_received"] += bytes_received
+            endpoint["bytes_decoded"] += bytes_decoded
+            endpoint["rate_limit_wait_seconds"] += rate_limit_wait
+
+    def add_backoff(self, method, url, delay):
+        with self.lock:
+            endpoint = self._get_endpoint(method, url)
+            endpoint["retries"] += 1
+            endpoint["backoff_seconds"] += delay
+
+    def add_json_decode(self, method, url, seconds):
+        with self.lock:
+            self._get_endpoint(method, url)["json_decode_seconds"] += seconds
+
+    def decode_json(self, method, url, data):
+        decode_start = time.perf_counter()
+        json_data = json.loads(data)
+        self.add_json_decode(method, url, time.perf_counter() - decode_start)
+        return json_data
+
+    def to_json(self, run_metrics, labels=None):
+        metrics = dict(run_metrics)
+        if labels:
+            metrics["labels"] = dict(labels)
+        metrics["started"] = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started))
+        metrics["endpoints"] = {}
+        for endpoint_name, endpoint in self.endpoints.items():
+            endpoint = dict(endpoint)
+            latency_histogram = { str(bucket): count for bucket, count in zip(self.LATENCY_BUCKETS, endpoint.pop("latency_buckets")) }
+            latency_histogram["+Inf"] = endpoint["requests"]
+            endpoint["latency_histogram"] = latency_histogram
+            metrics["endpoints"][endpoint_name] = endpoint
+        return json.dumps(metrics, indent=2) + "\n"
+
+    def to_prometheus(self, run_metrics, labels=None):
+        script = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+        script_labels = f'script="{script}"'
+        for label_name, label_value in (labels or {}).items():
+            script_labels += f',{label_name}="{label_value}"'
+        lines = []
+        for name, value in run_metrics.items():
+            lines.append(f"# TYPE sysdig_script_{name} gauge")
+            lines.append(f'sysdig_script_{name}{{{script_labels}}} {float(value)}')
+        counters = [
+            ("http_response_bytes_total", "bytes_received"),
+            ("http_response_decoded_bytes_total", "bytes_decoded"),
+            ("http_retries_total", "retries"),
+            ("http_backoff_seconds_total", "backoff_seconds"),
+            ("http_rate_limit_wait_seconds_total", "rate_limit_wait_seconds"),
+            ("json_decode_seconds_total", "json_decode_seconds"),
+        ]
+        lines.append("# TYPE sysdig_script_http_requests_total counter")
+        for endpoint_name, endpoint in self.endpoints.items():
+            for status, count in endpoint["status_codes"].items():
+                lines.append(f'sysdig_script_http_requests_total{{{script_labels},endpoint="{endpoint_name}",status="{status}"}} {count}')
+        lines.append("# TYPE sysdig_script_http_request_duration_seconds histogram")
+        for endpoint_name, endpoint in self.endpoints.items():
+            endpoint_labels = f'{script_labels},endpoint="{endpoint_name}"'
+            for bucket, count in zip(self.LATENCY_BUCKETS, endpoint["latency_buckets"]):
+                lines.append(f'sysdig_script_http_request_duration_seconds_bucket{{{endpoint_labels},le="{bucket}"}} {count}')
+            lines.append(f'sysdig_script_http_request_duration_seconds_bucket{{{endpoint_labels},le="+Inf"}} {endpoint["requests"]}')
+            lines.append(f'sysdig_script_http_request_duration_seconds_sum{{{endpoint_labels}}} {endpoint["latency_seconds"]}')
+            lines.append(f'sysdig_script_http_request_duration_seconds_count{{{endpoint_labels}}} {endpoint["requests"]}')
+        for metric_name, key in counters:
+            lines.append(f"# TYPE sysdig_script_{metric_name} counter")
+            for endpoint_name, endpoint in self.endpoints.items():
+                lines.append(f'sysdig_script_{metric_name}{{{script_labels},endpoint="{endpoint_name}"}} {endpoint[key]}')
+        return "\n".join(lines) + "\n"
+
+    def save(self, metrics_file_name, metrics_format, run_metrics, labels=None):
+        with self.lock:
+            if metrics_format == "prometheus":
+                metrics_data = self.to_prometheus(run_metrics, labels)
+            else:
+                metrics_data = self.to_json(run_metrics, labels)
+        with open(metrics_file_name, "w") as metrics_file:
+            metrics_file.write(metrics_data)
+
+class SysdigApiClient:
+    """
+    Pooled and rate limited client of one Sysdig Secure tenant. The client
+    is shared by every worker thread, size max_connections to the number of
+    workers so each one can keep a connection alive.
+    """
+
+    def __init__(self, secure_url_authority, api_token=None, max_connections=1, max_requests_per_second=20.0, timeout=None, retries=3, compress=True):
+        self.base_url = f"https://{secure_url_authority}"
+        headers = {}
+        if api_token != None:
+            headers["Authorization"] = f"Bearer {api_token}"
+        if compress:
+            # urllib3 decompresses the body as it is read, streamed or not
+            headers["Accept-Encoding"] = "gzip, deflate"
+        if timeout == None:
+            timeout = urllib3.Timeout(connect=30.0, read=300.0)
+        # throttling retries are handled by the rate limiter
+        self.http_client = urllib3.PoolManager(
+            maxsize=max_connections,
+            block=max_connections > 1,
+            headers=headers,
+            timeout=timeout,
+            retries=urllib3.Retry(total=retries, respect_retry_after_header=False),
+        )
+        self.rate_limiter = RateLimiter(max_rate=max_requests_per_second)
+        self.metrics = RequestMetrics()
+        self.num_of_429 = 0
+        self.num_of_504 = 0
+        self.counter_lock = threading.Lock()
+
+    def get_url(self, api_path):
+        if api_path.startswith("https://") or api_path.startswith("http://"):
+            return api_path
+        return f"{self.base_url}/{api_path.lstrip('/')}"
+
+    def request(self, method, api_path, stream=False, allowed_statuses=None):
+
+        """
+        Returns the response of the first successful request. A streamed
+        response is returned unread and the caller must release it. The
+        allowed statuses are returned instead of raised.
+        """
+
+        url = self.get_url(api_path)
+
+        try:
+
+            attempt = 0
+
+            while True:
+
+                LOG.debug(f"Sending http request to: {url}")
+
+                wait_start = time.perf_counter()
+                self.rate_limiter.acquire()
+                request_start = time.perf_counter()
+                response = self.http_client.request(method=method, url=url, redirect=True, preload_content=not stream)
+
+                LOG.debug(f"Response status: {response.status}")
+
+                if response.status == 200 and stream:
+                    # the body is still to be read so only the headers are timed
+                    # and the compressed size is taken from the headers
+                    content_length = response.headers.get("Content-Length", "0")
+                    self.metrics.add_request(method, url, response.status, time.perf_counter() - request_start, int(content_length) if content_length.isdigit() else 0, request_start - wait_start)
+                    self.rate_limiter.success(response.headers)
+                    return response
+
+                response_data = response.data
+                if stream:
+                    response.release_conn()
+                self.metrics.add_request(method, url, response.status, time.perf_counter() - request_start, response.tell(), request_start - wait_start, len(response_data))
+
+                if response.status == 200 or (allowed_statuses != None and response.status in allowed_statuses):
+                    self.rate_limiter.success(response.headers)
+                    return response
+
+                elif response.status in [ 429, 504 ]:
+
+                    with self.counter_lock:
+                        if response.status == 429:
+                            message = "API throttling"
+                            self.num_of_429 += 1
+                        else:
+                            message = "Gateway Timeout"
+                            self.num_of_504 += 1
+
+                    attempt += 1
+                    delay = self.rate_limiter.backoff(attempt, response.headers.get("Retry-After"), response.status == 429)
+                    self.metrics.add_backoff(method, url, delay)
+
+                    LOG.debug(f"Response data: {response_data}")
+                    LOG.debug(f"Retrying request in {delay:0.1f} seconds due to {message}...")
+
+                else:
+                    raise UnexpectedHTTPResponse(
+                        f"Unexpected HTTP response status: {response.status}", response.status
+                    )
+
+        except Exception as e:
+            LOG.critical(e)
+            LOG.critical(f"Error while requesting url: {url}")
+            raise
+
+    def get(self, api_path):
+        return self.request("GET", api_path).data.decode()
+
+    def get_stream(self, api_path):
+        return self.request("GET", api_path, stream=True)
+
+    def get_json(self, api_path):
+        url = self.get_url(api_path)
+        return self.metrics.decode_json("GET", url, self.request("GET", url).data)
+
+    def delete(self, api_path):
+        return self.request("DELETE", api_path).data.decode()
+
+    def delete_all(self, api_paths, workers=8, progress_seconds=10.0):
+
+        """
+        Deletes every passed path with up to workers requests in flight, size
+        max_connections to match. A path that is not found was deleted
+        already, a failed delete is logged and the others carry on. Returns
+        the counts of deleted, already deleted and failed paths.
+        """
+
+        api_paths = list(api_paths)
+        counts = { "deleted": 0, "not_found": 0, "failed": 0 }
+
+        def delete_path(api_path):
+            try:
+                return self.request("DELETE", api_path, allowed_statuses=[ 204, 404 ]).status
+            except Exception:
+                # the failure is logged by request
+                return None
+
+        pc_start = time.perf_counter()
+        next_progress = pc_start + progress_seconds
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+
+            for num_done, status in enumerate(executor.map(delete_path, api_paths), 1):
+
+                if status == 404:
+                    counts["not_found"] += 1
+                elif status != None:
+                    counts["deleted"] += 1
+                else:
+                    counts["failed"] += 1
+
+                now = time.perf_counter()
+                if now >= next_progress or num_done == len(api_paths):
+                    next_progress = now + progress_seconds
+                    rate = num_done / (now - pc_start) if now > pc_start else 0
+                    eta = timedelta(seconds=round((len(api_paths) - num_done) / rate)) if rate > 0 else "unknown"
+                    LOG.info(f"Processed {num_done} of {len(api_paths)} ({num_done / len(api_paths):0.1%}) at {rate:0.1f}/second, ETA {eta}: {counts['deleted']} deleted, {counts['not_found']} already deleted, {counts['failed']} failed.")
+
+            #end for
+
+        return counts
+
+    def paginate(self, api_path, query="", limit=100, cursor=""):
+
+        """
+        Yields each page of a cursor paginated endpoint, the last page has no
+        next cursor or an empty one.
+        """
+
+        while True:
+
+            page_path = f"{api_path}?cursor={cursor}"
+            if query != "":
+                page_path += f"&{query}"
+            page_path += f"&limit={limit}"
+
+            json_response = self.get_json(page_path)
+
+            yield json_response
+
+            cursor = json_response["page"].get("next")
+            if cursor in [ None, "" ]:
+                break
+
+        #end while
+
+    def paginate_prefetch(self, api_path, query="", limits=(1000, 500, 200, 100), cursor=""):
+
+        """
+        Yields the same pages as paginate, but each page is requested and
+        parsed by a background thread and the next page is requested as soon
+        as its cursor is known, while the caller handles the current page.
+        The first page is requested with the largest of the limits the API
+        accepts, a limit rejected with 400 or 422 is tried with the next one.
+        """
+
+        def get_page(page_cursor, page_limits):
+            for limit_idx, limit in enumerate(page_limits):
+                page_path = f"{api_path}?cursor={page_cursor}"
+                if query != "":
+                    page_path += f"&{query}"
+                page_path += f"&limit={limit}"
+                url = self.get_url(page_path)
+                last_limit = limit_idx == len(page_limits) - 1
+                response = self.request("GET", url, allowed_statuses=None if last_limit else [ 400, 422 ])
+                if response.status == 200:
+                    return limit, self.metrics.decode_json("GET", url, response.data)
+                LOG.debug(f"The page limit {limit} was rejected with {response.status}, trying {page_limits[limit_idx + 1]}")
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+
+            page_future = executor.submit(get_page, cursor, limits)
+
+            while True:
+
+                limit, json_response = page_future.result()
+
+                cursor = json_response["page"].get("next")
+                if cursor not in [ None, "" ]:
+                    page_future = executor.submit(get_page, cursor, [ limit ])
+
+                yield json_response
+
+                if cursor in [ None, "" ]:
+                    break
+
+            #end while
+
+    def save_metrics(self, metrics_file_name, metrics_format, run_metrics, labels=None):
+        self.metrics.save(metrics_file_name, metrics_format, run_metrics, labels)
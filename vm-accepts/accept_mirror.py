@@ -0,0 +1,169 @@
+"""
+  Local SQLite mirror of the vulnerability risk accept definitions shared by
+  the scripts in this folder. Pass --accepts_db to a script to sync the
+  mirror and read the accepts from it, add --no_sync to read the mirror as
+  it is without calling the API.
+
+  The API has no filter for the accepts changed since a time so a sync
+  still lists every accept, but only the new and changed accepts are
+  written and the accepts no longer listed are removed. An accept changed
+  when the hash of its json differs from the mirrored one.
+
+  The accepts are indexed by entity type, status, expiration date and
+  context value so they can be queried without the API.
+"""
+
+import logging
+import sqlite3
+import hashlib
+import json
+import time
+
+LOG = logging.getLogger(__name__)
+
+class AcceptMirror:
+    """
+    The accepts table holds each accept as json next to the indexed fields,
+    the accept_contexts table holds one row per accept context.
+    """
+
+    def __init__(self, db_file_name):
+        self.conn = sqlite3.connect(db_file_name)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS accepts (id TEXT PRIMARY KEY, entity_type TEXT, entity_value TEXT, status TEXT, expiration_date TEXT, data_hash TEXT, data TEXT)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS accept_contexts (accept_id TEXT, context_type TEXT, context_value TEXT)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value TEXT)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS accepts_entity ON accepts (entity_type, entity_value)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS accepts_status ON accepts (status)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS accepts_expiration_date ON accepts (expiration_date)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS accept_contexts_value ON accept_contexts (context_value, context_type)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS accept_contexts_accept_id ON accept_contexts (accept_id)")
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def sync(self, api_client, api_path="api/scanning/riskmanager/v2/definitions"):
+        """Returns the number of added, changed, removed and unchanged accepts"""
+
+        pc_start = time.perf_counter()
+        counts = { "added": 0, "changed": 0, "removed": 0, "unchanged": 0 }
+        mirrored_hashes = dict(self.conn.execute("SELECT id, data_hash FROM accepts"))
+        listed_ids = set()
+
+        with self.conn:
+
+            for json_response in api_client.paginate_prefetch(api_path):
+
+                for accept in json_response['data']:
+
+                    accept_id = accept['riskAcceptanceDefinitionID']
+                    listed_ids.add(accept_id)
+                    # the keys are sorted for the hash only, the json keeps the listed key order
+                    data_hash = hashlib.sha1(json.dumps(accept, sort_keys=True).encode()).hexdigest()
+
+                    if mirrored_hashes.get(accept_id) == data_hash:
+                        counts["unchanged"] += 1
+                        continue
+
+                    counts["added" if accept_id not in mirrored_hashes else "changed"] += 1
+                    self._write_accept(accept_id, accept, data_hash)
+
+                #end for
+
+            removed_ids = [ accept_id for accept_id in mirrored_hashes if accept_id not in listed_ids ]
+            self.remove(removed_ids, commit=False)
+            counts["removed"] = len(removed_ids)
+
+            self.conn.execute("INSERT INTO sync_state (key, value) VALUES ('synced_at', ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+                              (time.strftime("%Y-%m-%dT%H:%M:%S"),))
+
+        LOG.info(f"Synced the accept mirror in {time.perf_counter() - pc_start:0.2f} seconds: {counts['added']} added, {counts['changed']} changed, {counts['removed']} removed and {counts['unchanged']} unchanged.")
+
+        return counts
+
+    def _write_accept(self, accept_id, accept, data_hash):
+
+        # an upsert keeps the rowid so the accepts stay in the listed order
+        self.conn.execute(
+            "INSERT INTO accepts (id, entity_type, entity_value, status, expiration_date, data_hash, data) VALUES (?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (id) DO UPDATE SET entity_type = excluded.entity_type, entity_value = excluded.entity_value, status = excluded.status, "
+            "expiration_date = excluded.expiration_date, data_hash = excluded.data_hash, data = excluded.data",
+            (accept_id, accept.get('entityType'), accept.get('entityValue'), accept.get('status'), accept.get('expirationDate'), data_hash, json.dumps(accept)),
+        )
+        self.conn.execute("DELETE FROM accept_contexts WHERE accept_id = ?", (accept_id,))
+        self.conn.executemany(
+            "INSERT INTO accept_contexts (accept_id, context_type, context_value) VALUES (?, ?, ?)",
+            [ (accept_id, context.get('contextType'), context.get('contextValue')) for context in accept.get('context') or [] ],
+        )
+
+    def remove(self, accept_ids, commit=True):
+        """Removes deleted accepts so the mirror is current without a sync"""
+        for accept_id in accept_ids:
+            self.conn.execute("DELETE FROM accepts WHERE id = ?", (accept_id,))
+            self.conn.execute("DELETE FROM accept_contexts WHERE accept_id = ?", (accept_id,))
+        if commit:
+            self.conn.commit()
+
+    def get_synced_at(self):
+        row = self.conn.execute("SELECT value FROM sync_state WHERE key = 'synced_at'").fetchone()
+        return row[0] if row != None else None
+
+    def iter_accepts(self, entity_type=None, status=None, context_type=None, context_value=None, expires_before=None):
+
+        """
+        Yields the mirrored accepts in the order they were listed, limited to
+        the passed entity type, status, context and expiration date.
+        """
+
+        conditions = []
+        parameters = []
+        if entity_type != None:
+            conditions.append("entity_type = ?")
+            parameters.append(entity_type)
+        if status != None:
+            conditions.append("status = ?")
+            parameters.append(status)
+        if expires_before != None:
+            conditions.append("expiration_date < ?")
+            parameters.append(expires_before)
+        if context_type != None or context_value != None:
+            context_conditions = []
+            if context_value != None:
+                context_conditions.append("context_value = ?")
+                parameters.append(context_value)
+            if context_type != None:
+                context_conditions.append("context_type = ?")
+                parameters.append(context_type)
+            conditions.append(f"id IN (SELECT accept_id FROM accept_contexts WHERE {' AND '.join(context_conditions)})")
+
+        query = "SELECT data FROM accepts"
+        if len(conditions) > 0:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY rowid"
+
+        for (data,) in self.conn.execute(query, parameters):
+            yield json.loads(data)
+
+    def get_accepts(self, **filters):
+        return list(self.iter_accepts(**filters))
+
+def open_accept_mirror(accepts_db, api_client, sync=True):
+
+    """
+    Opens the mirror of the --accepts_db option and syncs it unless told
+    not to, returns None when no mirror is used.
+    """
+
+    if accepts_db == None:
+        if not sync:
+            raise Exception(f"Reading the accepts without a sync requires --accepts_db")
+        return None
+
+    accept_mirror = AcceptMirror(accepts_db)
+
+    if sync:
+        accept_mirror.sync(api_client)
+    else:
+        LOG.info(f"Reading the accepts from {accepts_db} last synced at {accept_mirror.get_synced_at()}.")
+
+    return accept_mirror
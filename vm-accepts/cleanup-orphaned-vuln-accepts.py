@@ -10,21 +10,46 @@
      accept.context_type.context.contextType == "imageName" (Image CVE)
      accept.entity_type == "imageName" (Global Image)
 
-  Currently Does NOT handle:
-     accept.context.contextType: imageAssetToken
-     accept.context.contextType: imagePrefix
-     accept.context.contextType: imageSuffix
-     accept.context.contextType: packageName
+  Handled when passed to --context_types:
+     accept.context.contextType: imagePrefix (a running image starts with it)
+     accept.context.contextType: imageSuffix (a running image ends with it)
+     accept.context.contextType: imageAssetToken (the image id or pull string
+                                 of a running image, check the orphans found
+                                 before using --delete as the token format is
+                                 assumed)
+
+  Handled with --check_packages:
+     accept.context.contextType: packageName (a package of a running image)
+
+  An accept with several contexts is an orphan when any of the handled
+  contexts matches no running image. Accepts without a context and contexts
+  that are not handled are never orphans.
+
+  The running images are indexed once, image names and asset tokens in
+  sets and the prefixes and suffixes in sorted lists searched by bisection,
+  so every accept is matched without scanning the image list.
+
+  Use --accepts_db to keep a local mirror of the accepts that is synced
+  incrementally, add --no_sync to read it without calling the API.
+
+  With --delete the orphans are deleted by --workers concurrent requests,
+  an orphan that is not found was deleted already.
 """
 
 import logging
-import urllib3
 import sys
 import argparse
 from datetime import datetime
 import time
 import json
 import os
+import bisect
+from concurrent.futures import ThreadPoolExecutor
+
+# Shared Sysdig API client in the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from sysdig_api_client import SysdigApiClient
+from accept_mirror import open_accept_mirror
 
 # Setup logger
 LOG = logging.getLogger(__name__)
@@ -33,14 +58,57 @@ logging.basicConfig(
     format="%(asctime)s.%(msecs)03d %(levelname)s - %(funcName)s: %(message)s",
     datefmt="%Y-%m-%d %H:%M:%S",
 )
-logging.getLogger("urllib3").setLevel(logging.CRITICAL)
-
-# Setup http client
-http_client = urllib3.PoolManager()
 
-# Define custom exceptions
-class UnexpectedHTTPResponse(Exception):
-    """Used when recieving an unexpected HTTP response"""
+# Will be set by a passed arg
+api_client = None
+
+# Context types that are only matched when passed to --context_types
+OPTIONAL_CONTEXT_TYPES = ["imagePrefix", "imageSuffix", "imageAssetToken"]
+
+class RuntimeImageIndex:
+    """
+    Index of the running images that answers whether an accept context
+    matches any of them. Only imageName and the passed context types are
+    matched, the packageName contexts once the package names are added.
+    The sorted image names find a prefix by bisecting to the first name not
+    before it, the reversed names do the same for a suffix.
+    """
+
+    def __init__(self, runtime_scan_results_list, context_types=None):
+        self.context_types = set(["imageName"] + list(context_types or []))
+        self.image_names = set()
+        self.asset_tokens = set()
+        self.package_names = None
+        for result in runtime_scan_results_list:
+            self.image_names.add(result['mainAssetName'])
+            self.asset_tokens.add(result['mainAssetName'])
+            if result.get('resourceId'):
+                self.asset_tokens.add(result['resourceId'])
+        self.sorted_image_names = sorted(self.image_names)
+        self.sorted_reversed_image_names = sorted([ image_name[::-1] for image_name in self.image_names ])
+
+    def add_package_names(self, package_names):
+        self.package_names = set(package_names)
+
+    def _has_prefix(self, sorted_names, prefix):
+        name_idx = bisect.bisect_left(sorted_names, prefix)
+        return name_idx < len(sorted_names) and sorted_names[name_idx].startswith(prefix)
+
+    def matches(self, context_type, context_value):
+        """Context types that are not handled always match"""
+        if context_type not in self.context_types and context_type != "packageName":
+            return True
+        if context_type == "imageName":
+            return context_value in self.image_names
+        if context_type == "imagePrefix":
+            return self._has_prefix(self.sorted_image_names, context_value)
+        if context_type == "imageSuffix":
+            return self._has_prefix(self.sorted_reversed_image_names, context_value[::-1])
+        if context_type == "imageAssetToken":
+            return context_value in self.asset_tokens
+        if context_type == "packageName" and self.package_names != None:
+            return context_value in self.package_names
+        return True
 
 def _parse_args():
 
@@ -76,20 +144,97 @@ def _parse_args():
         action="store_true",
         help="Orphans will be deleted",
     )
+    parser.add_argument(
+        "--check_packages",
+        required=False,
+        action="store_true",
+        help="Retrieve the scan result of every running image to find the orphaned packageName accepts",
+    )
+    parser.add_argument(
+        "--context_types",
+        required=False,
+        type=str,
+        default="",
+        action="store",
+        help=f"Comma separated context types to match besides imageName, from {','.join(OPTIONAL_CONTEXT_TYPES)} (default: none)",
+    )
+    parser.add_argument(
+        "--workers",
+        required=False,
+        type=int,
+        default=8,
+        action="store",
+        help="Number of accepts deleted or scan results retrieved at the same time (default: 8)",
+    )
+    parser.add_argument(
+        "--max_requests_per_second",
+        required=False,
+        type=float,
+        default=20.0,
+        action="store",
+        help="Maximum number of API requests per second, lowered while the API throttles (default: 20)",
+    )
+    parser.add_argument(
+        "--accepts_db",
+        required=False,
+        type=str,
+        action="store",
+        help="SQLite mirror of the accept definitions, it is synced with the API and the accepts are read from it",
+    )
+    parser.add_argument(
+        "--no_sync",
+        required=False,
+        action="store_true",
+        help="Read the accepts from --accepts_db without syncing it first",
+    )
+    parser.add_argument(
+        "--metrics_out",
+        required=False,
+        type=str,
+        action="store",
+        help="File to save the request metrics of each endpoint to",
+    )
+    parser.add_argument(
+        "--metrics_format",
+        required=False,
+        type=str,
+        choices=["json", "prometheus"],
+        default="json",
+        action="store",
+        help="Format of the metrics file, json or prometheus text (default: json)",
+    )
     return parser.parse_args()
 
 def main():
 
+    metrics_out = None
+    run_succeeded = False
+    run_start = time.perf_counter()
+
     try:
 
         LOG.info('Starting process to cleanup orphaned accepts...')
 
         # Parse the command line arguments
         args = _parse_args()
+        metrics_out = args.metrics_out
+        metrics_format = args.metrics_format
         secure_url_authority = args.secure_url_authority
         authentication_bearer = args.api_token
         output_file = args.output_file
         delete_orphans = args.delete
+        context_types = [ context_type.strip() for context_type in args.context_types.split(",") if context_type.strip() != "" ]
+
+        # Validate the context types
+        for context_type in context_types:
+            if context_type not in OPTIONAL_CONTEXT_TYPES:
+                raise Exception(f"Unknown context type {context_type}, use one or more of: {','.join(OPTIONAL_CONTEXT_TYPES)}")
+
+        # Validate the delete concurrency
+        if args.workers < 1:
+            raise Exception(f"The number of workers must be at least 1: {args.workers}")
+        if args.max_requests_per_second <= 0:
+            raise Exception(f"The maximum requests per second must be greater than 0: {args.max_requests_per_second}")
 
         # Validate the output file
         if output_file != None and os.path.isfile(output_file):
@@ -99,280 +244,185 @@ def main():
         now = datetime.now()
         current_datetime = now.strftime("%Y-%m-%d %H:%M")
 
-        # Add the authentication header
-        http_client.headers["Authorization"] = f"Bearer {authentication_bearer}"
+        # Setup the api client
+        global api_client
+        api_client = SysdigApiClient(secure_url_authority, authentication_bearer, max_connections=args.workers, max_requests_per_second=args.max_requests_per_second)
 
         # Start performance counter
         pc_start = time.perf_counter()
 
+        # Sync the accept mirror
+        accept_mirror = open_accept_mirror(args.accepts_db, api_client, not args.no_sync)
+
         # Get the runtime scan results
         LOG.info(f"Retrieving the runtime scan results...")
-        runtime_scan_results_list = _get_runtime_scan_results_list(secure_url_authority)
+        runtime_scan_results_list = _get_runtime_scan_results_list()
         
-        # Build a unique image list from the runtime results list
-        unique_runtime_image_list = _build_unique_runtime_image_list(runtime_scan_results_list)
-        LOG.info(f"Found {len(unique_runtime_image_list)} unique images in {len(runtime_scan_results_list)} scan results.")
+        # Index the running images
+        runtime_image_index = RuntimeImageIndex(runtime_scan_results_list, context_types)
+        LOG.info(f"Found {len(runtime_image_index.image_names)} unique images in {len(runtime_scan_results_list)} scan results.")
 
         # Get all accepts
-        all_vuln_risk_accepts = _get_all_vuln_risk_accepts(secure_url_authority)
+        all_vuln_risk_accepts = _get_all_vuln_risk_accepts(accept_mirror)
         LOG.info(f"Found {len(all_vuln_risk_accepts)} vulnerability risk accepts.")
-        
-        # Get the image accepts
-        image_vuln_risk_accept_ids = []
-        if len(all_vuln_risk_accepts) > 0:
-            image_vuln_risk_accept_ids = _get_image_vuln_risk_accepts(all_vuln_risk_accepts)
-            LOG.info(f"Found {len(image_vuln_risk_accept_ids)} images with vulnerability risk accepts.")
+
+        # Index the packages of the running images when they are needed
+        if args.check_packages and _has_context_type(all_vuln_risk_accepts, "packageName"):
+            LOG.info(f"Retrieving the packages of the running images...")
+            runtime_image_index.add_package_names(_get_runtime_package_names(runtime_scan_results_list, args.workers))
+            LOG.info(f"Found {len(runtime_image_index.package_names)} unique packages in the running images.")
 
         # Identify orphaned accepts
-        image_orphaned_risk_accepts_ids = []
-        if len(image_vuln_risk_accept_ids) > 0:
-            image_orphaned_risk_accepts_ids = _find_orphaned_risk_accepts(unique_runtime_image_list, image_vuln_risk_accept_ids)
-            LOG.info(f"Found {len(image_orphaned_risk_accepts_ids)} orphaned images with vulnerability risk accepts.")
-            orphaned_risk_accepts_count = _count_orphaned_risk_accepts(image_orphaned_risk_accepts_ids)
-            LOG.info(f"Found {orphaned_risk_accepts_count} orphaned vulnerability risk accepts.")
+        orphaned_risk_accepts = _find_orphaned_risk_accepts(runtime_image_index, all_vuln_risk_accepts)
+        LOG.info(f"Found {len(orphaned_risk_accepts)} orphaned vulnerability risk accepts.")
 
         # Save orphaned accepts to a file
-        if output_file != None and len(image_orphaned_risk_accepts_ids) > 0:
-            _save_orphaned_accepts(output_file, all_vuln_risk_accepts, image_orphaned_risk_accepts_ids)
+        if output_file != None and len(orphaned_risk_accepts) > 0:
+            _save_orphaned_accepts(output_file, orphaned_risk_accepts)
             LOG.info(f"Saved orphaned risk accepts to: {output_file}")
-        elif output_file != None and len(image_orphaned_risk_accepts_ids) == 0:
+        elif output_file != None and len(orphaned_risk_accepts) == 0:
             LOG.info(f"There is nothing to save to: {output_file}")
 
         # Delete orphaned accepts
-        if not delete_orphans and len(image_orphaned_risk_accepts_ids) > 0:
+        if not delete_orphans and len(orphaned_risk_accepts) > 0:
             LOG.info(f"Skipping delete of orphaned vulnerability risk accepts.")
-        elif delete_orphans and len(image_orphaned_risk_accepts_ids) > 0:
-            LOG.info(f"Deleting orphaned image vulnerability risk accepts.")
-            _delete_orphaned_risk_accepts(secure_url_authority, image_orphaned_risk_accepts_ids)
-            LOG.info(f"Deleted orphaned image vulnerability risk accepts.")
+        elif delete_orphans and len(orphaned_risk_accepts) > 0:
+            LOG.info(f"Deleting orphaned vulnerability risk accepts.")
+            _delete_orphaned_risk_accepts(orphaned_risk_accepts, args.workers)
+            if accept_mirror != None:
+                accept_mirror.remove(orphaned_risk_accepts.keys())
+            LOG.info(f"Deleted orphaned vulnerability risk accepts.")
         else:
-            LOG.info(f"No orphaned image vulnerability risk accepts found.")
+            LOG.info(f"No orphaned vulnerability risk accepts found.")
 
         # End performance counter
         pc_end = time.perf_counter()
         LOG.info(f"Elapsed execution time: {pc_end - pc_start:0.4f} seconds")
 
         LOG.info('Request to cleanup orphaned accepts complete.')
+        run_succeeded = True
 
     except Exception as e:
         LOG.critical(e)
         LOG.critical('Request to cleanup orphaned accepts failed.')
         raise SystemExit()
+    finally:
+        if metrics_out != None and api_client != None:
+            api_client.save_metrics(metrics_out, metrics_format, { "run_duration_seconds": time.perf_counter() - run_start, "run_succeeded": int(run_succeeded) })
+            LOG.info(f"Saved the run metrics to {metrics_out}")
 
-def _save_orphaned_accepts(output_file, all_vuln_risk_accepts, image_orphaned_risk_accepts_ids):
-    
-    orphaned_accept_ids = []
-    accepts_to_save = []
-   
-    for image_name in image_orphaned_risk_accepts_ids.keys():
-        for accept_def_id in image_orphaned_risk_accepts_ids[image_name]:
-            orphaned_accept_ids.append(accept_def_id)
-
-    for accept in all_vuln_risk_accepts:
-        acceptId = accept['riskAcceptanceDefinitionID']
-        if acceptId in orphaned_accept_ids:
-            accepts_to_save.append(accept)
+def _save_orphaned_accepts(output_file, orphaned_risk_accepts):
 
     with open(output_file, "w") as outfile:
-        json.dump(accepts_to_save, outfile, indent=2)
+        json.dump(list(orphaned_risk_accepts.values()), outfile, indent=2)
 
-def _count_orphaned_risk_accepts(image_orphaned_risk_accepts_ids):
+def _delete_orphaned_risk_accepts(orphaned_risk_accepts, workers=8):
 
-    count = 0
+    api_path = "api/scanning/riskmanager/v2/definitions"
 
-    for image_name in image_orphaned_risk_accepts_ids.keys():
-        for accept_def_id in image_orphaned_risk_accepts_ids[image_name]:
-            count += 1
+    LOG.info(f"Deleting {len(orphaned_risk_accepts)} orphaned vulnerability risk accepts with {workers} workers...")
+    counts = api_client.delete_all([ f"{api_path}/{accept_def_id}" for accept_def_id in orphaned_risk_accepts ], workers)
+    LOG.info(f"Deleted {counts['deleted']} orphaned vulnerability risk accepts, {counts['not_found']} were already deleted.")
 
-    return count
+    if counts["failed"] > 0:
+        raise Exception(f"Failed to delete {counts['failed']} orphaned vulnerability risk accepts")
 
-def _delete_orphaned_risk_accepts(secure_url_authority, image_orphaned_risk_accepts_ids):
+    return
 
-    api_path = "api/scanning/riskmanager/v2/definitions"
-    deleted_ids = []
+def _find_orphaned_risk_accepts(runtime_image_index, all_vuln_risk_accepts):
 
-    for image_name in image_orphaned_risk_accepts_ids.keys():
-        for accept_def_id in image_orphaned_risk_accepts_ids[image_name]:
-            if accept_def_id not in deleted_ids:
-                api_url = f"https://{secure_url_authority}/{api_path}/{accept_def_id}"
-                _delete_data_from_http_request(api_url)
-                deleted_ids.append(accept_def_id)
-            else:
-                LOG.debug(f"Found accept already deleted: {accept_def_id}")
+    """
+    Returns the orphaned accepts by their accept id in the order they were
+    listed. An accept is an orphan when any of its contexts does not match
+    a running image.
+    """
 
-    return
+    orphaned_risk_accepts = {}
+    context_type_counts = {}
 
-def _find_orphaned_risk_accepts(unique_runtime_image_list, image_vuln_risk_accept_ids):
+    for accept in all_vuln_risk_accepts:
 
-    image_orphaned_risk_accepts_ids = []
-    image_vuln_risk_accept_ids_copy = image_vuln_risk_accept_ids.copy()
+        for context_type, context_value in _get_accept_contexts(accept):
+            if not runtime_image_index.matches(context_type, context_value):
+                orphaned_risk_accepts[accept['riskAcceptanceDefinitionID']] = accept
+                context_type_counts[context_type] = context_type_counts.get(context_type, 0) + 1
+                break
 
-    images_still_running = [value for value in image_vuln_risk_accept_ids.keys() if value in unique_runtime_image_list]
+    #end for
 
-    for image in images_still_running:
-        del image_vuln_risk_accept_ids_copy[image]
+    for context_type, count in context_type_counts.items():
+        LOG.info(f"Found {count} orphaned {context_type} vulnerability risk accepts.")
 
-    image_orphaned_risk_accepts_ids = image_vuln_risk_accept_ids_copy
+    return orphaned_risk_accepts
 
-    return image_orphaned_risk_accepts_ids
+def _get_accept_contexts(accept):
 
-def _get_image_vuln_risk_accepts(all_vuln_risk_accepts):
+    entity_type = accept['entityType']
 
-    image_vuln_risk_accept_ids = {}
+    # Global Image Accepts
+    if entity_type == "imageName":
+        return [ ("imageName", accept['entityValue']) ]
 
-    for accept in all_vuln_risk_accepts:
-        entity_type = accept['entityType']
+    # Image CVE Accepts
+    if entity_type == "vulnerability":
+        return [ (context['contextType'], context['contextValue']) for context in accept['context'] ]
 
-        # Image CVE Accepts
-        if entity_type == "vulnerability" and len(accept['context']) > 0:
-            
-            context_type = accept['context'][0]['contextType']
+    return []
 
-            if context_type == "imageName":
-                accept_def_id = accept['riskAcceptanceDefinitionID']
-                image_name = accept['context'][0]['contextValue']
+def _has_context_type(all_vuln_risk_accepts, context_type):
 
-                if image_name not in image_vuln_risk_accept_ids.keys():
-                    image_vuln_risk_accept_ids[image_name] = []
+    for accept in all_vuln_risk_accepts:
+        for accept_context_type, context_value in _get_accept_contexts(accept):
+            if accept_context_type == context_type:
+                return True
 
-                image_vuln_risk_accept_ids[image_name].append(accept_def_id)
+    return False
 
-        # Global Image Accepts
-        elif entity_type == "imageName":
+def _get_runtime_package_names(runtime_scan_results_list, workers=8):
 
-            accept_def_id = accept['riskAcceptanceDefinitionID']
-            image_name = accept['entityValue']
+    api_path = "secure/vulnerability/v1beta1/results"
 
-            if image_name not in image_vuln_risk_accept_ids.keys():
-                image_vuln_risk_accept_ids[image_name] = []
+    # One scan result is enough for every workload running the same image
+    result_ids = {}
+    for result in runtime_scan_results_list:
+        result_ids.setdefault(result.get('resourceId') or result['mainAssetName'], result['resultId'])
 
-            image_vuln_risk_accept_ids[image_name].append(accept_def_id)
+    def get_package_names(result_id):
+        json_response = api_client.get_json(f"{api_path}/{result_id}")
+        return [ package.get("name", "") for package in json_response["result"].get("packages") or [] ]
 
-    #end for
+    package_names = set()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for image_package_names in executor.map(get_package_names, result_ids.values()):
+            package_names.update(image_package_names)
 
-    return image_vuln_risk_accept_ids
+    return package_names
 
+def _get_all_vuln_risk_accepts(accept_mirror=None):
 
-def _get_all_vuln_risk_accepts(secure_url_authority):
+    if accept_mirror != None:
+        return accept_mirror.get_accepts()
 
-    limit=100
-    cursor=""
     vuln_risk_accepts = []
 
-    while True:
-
-        api_path = "api/scanning/riskmanager/v2/definitions"
-        api_url = f"https://{secure_url_authority}/{api_path}?cursor={cursor}&limit={limit}"
-        response_data = _get_data_from_http_request(api_url)
-        json_response = json.loads(response_data)
-
+    # The next page is downloaded while this one is added, using the
+    # largest page size the API accepts
+    api_path = "api/scanning/riskmanager/v2/definitions"
+    for json_response in api_client.paginate_prefetch(api_path):
         vuln_risk_accepts.extend(json_response['data'])
 
-        if json_response["page"]["next"] != '':
-            cursor = json_response["page"]["next"]
-        else:
-            break
-
-    #end while
-
     return vuln_risk_accepts
 
-def _build_unique_runtime_image_list(runtime_scan_results_list):
-
-    unique_runtime_image_list = []
-
-    for result in runtime_scan_results_list:
-        image_name = result['mainAssetName']
-        if image_name not in unique_runtime_image_list:
-            unique_runtime_image_list.append(image_name)
-
-    return unique_runtime_image_list 
-
-def _get_runtime_scan_results_list(secure_url_authority):
+def _get_runtime_scan_results_list():
 
     limit=1000
-    cursor=""
     runtime_scan_results_list = []
 
-    while True:
-
-        api_path = "secure/vulnerability/v1beta1/runtime-results"
-        api_url = f"https://{secure_url_authority}/{api_path}?cursor={cursor}&limit={limit}"
-        response_data = _get_data_from_http_request(api_url)
-        json_response = json.loads(response_data)
-
+    api_path = "secure/vulnerability/v1beta1/runtime-results"
+    for json_response in api_client.paginate_prefetch(api_path, limits=[ limit ]):
         runtime_scan_results_list.extend(json_response['data'])
 
-        if "next" in json_response["page"]:
-            cursor = json_response["page"]["next"]
-        else:
-            break
-
-    #end while
-
     return runtime_scan_results_list
 
-def _delete_data_from_http_request(url):
-
-    response_data = None
-
-    try:
-
-        while True:
-            LOG.debug(f"Sending http request to: {url}")
-            response = http_client.request(method="DELETE", url=url, redirect=True)
-            response_data = response.data.decode()
-            LOG.debug(f"Response status: {response.status}")
-            if response.status == 200:
-                #LOG.debug(f"Response data: {response_data}")
-                break
-            elif response.status == 429:
-                LOG.debug(f"Response data: {response_data}")
-                LOG.info(f"Sleeping 60 seconds due to API throttling...")
-                time.sleep(60)
-                LOG.debug(f"Retrying request...")
-            else:
-                raise UnexpectedHTTPResponse(
-                    f"Unexpected HTTP response status: {response.status}"
-                )
-
-    except Exception as e:
-        LOG.critical(e)
-        LOG.critical(f"Error while requesting url: {url}")
-        raise SystemExit()
-
-    return response_data
-
-def _get_data_from_http_request(url):
-
-    response_data = None
-
-    try:
-
-        while True:
-            LOG.debug(f"Sending http request to: {url}")
-            response = http_client.request(method="GET", url=url, redirect=True)
-            response_data = response.data.decode()
-            LOG.debug(f"Response status: {response.status}")
-            if response.status == 200:
-                #LOG.debug(f"Response data: {response_data}")
-                break
-            elif response.status == 429:
-                LOG.debug(f"Response data: {response_data}")
-                LOG.info(f"Sleeping 60 seconds due to API throttling...")
-                time.sleep(60)
-                LOG.debug(f"Retrying request...")
-            else:
-                raise UnexpectedHTTPResponse(
-                    f"Unexpected HTTP response status: {response.status}"
-                )
-
-    except Exception as e:
-        LOG.critical(e)
-        LOG.critical(f"Error while requesting url: {url}")
-        raise SystemExit()
-
-    return response_data
-
 if __name__ == "__main__":
     sys.exit(main())
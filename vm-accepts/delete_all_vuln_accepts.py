@@ -3,17 +3,27 @@
 
   Author: Kendall Adkins
   Date December 6th, 2023
+
+  The accepts are deleted by --workers concurrent requests. An accept that
+  is not found was deleted already, the progress is logged every 10
+  seconds with an estimate of the time left.
+
+  Use --accepts_db to keep a local mirror of the accepts that is synced
+  incrementally, add --no_sync to read it without calling the API.
 """
 
 import logging
-import urllib3
 import sys
 import argparse
 from datetime import datetime
 import time
-import json
 import os
 
+# Shared Sysdig API client in the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from sysdig_api_client import SysdigApiClient
+from accept_mirror import open_accept_mirror
+
 # Setup logger
 LOG = logging.getLogger(__name__)
 logging.basicConfig(
@@ -21,14 +31,9 @@ logging.basicConfig(
     format="%(asctime)s.%(msecs)03d %(levelname)s - %(funcName)s: %(message)s",
     datefmt="%Y-%m-%d %H:%M:%S",
 )
-logging.getLogger("urllib3").setLevel(logging.CRITICAL)
-
-# Setup http client
-http_client = urllib3.PoolManager()
 
-# Define custom exceptions
-class UnexpectedHTTPResponse(Exception):
-    """Used when recieving an unexpected HTTP response"""
+# Will be set by a passed arg
+api_client = None
 
 def _parse_args():
 
@@ -51,57 +56,126 @@ def _parse_args():
         action="store",
         help="Sysdig Secure API Token",
     )
+    parser.add_argument(
+        "--workers",
+        required=False,
+        type=int,
+        default=8,
+        action="store",
+        help="Number of accepts deleted at the same time (default: 8)",
+    )
+    parser.add_argument(
+        "--max_requests_per_second",
+        required=False,
+        type=float,
+        default=20.0,
+        action="store",
+        help="Maximum number of API requests per second, lowered while the API throttles (default: 20)",
+    )
+    parser.add_argument(
+        "--accepts_db",
+        required=False,
+        type=str,
+        action="store",
+        help="SQLite mirror of the accept definitions, it is synced with the API and the accepts are read from it",
+    )
+    parser.add_argument(
+        "--no_sync",
+        required=False,
+        action="store_true",
+        help="Read the accepts from --accepts_db without syncing it first",
+    )
+    parser.add_argument(
+        "--metrics_out",
+        required=False,
+        type=str,
+        action="store",
+        help="File to save the request metrics of each endpoint to",
+    )
+    parser.add_argument(
+        "--metrics_format",
+        required=False,
+        type=str,
+        choices=["json", "prometheus"],
+        default="json",
+        action="store",
+        help="Format of the metrics file, json or prometheus text (default: json)",
+    )
     return parser.parse_args()
 
 def main():
 
+    metrics_out = None
+    run_succeeded = False
+    run_start = time.perf_counter()
+
     try:
 
         LOG.info('Starting process to delete all vulnerability accepts...')
 
         # Parse the command line arguments
         args = _parse_args()
+        metrics_out = args.metrics_out
+        metrics_format = args.metrics_format
         secure_url_authority = args.secure_url_authority
         authentication_bearer = args.api_token
 
+        # Validate the delete concurrency
+        if args.workers < 1:
+            raise Exception(f"The number of workers must be at least 1: {args.workers}")
+        if args.max_requests_per_second <= 0:
+            raise Exception(f"The maximum requests per second must be greater than 0: {args.max_requests_per_second}")
+
         # Get the timestamp of this run
         now = datetime.now()
         current_datetime = now.strftime("%Y-%m-%d %H:%M")
 
-        # Add the authentication header
-        http_client.headers["Authorization"] = f"Bearer {authentication_bearer}"
+        # Setup the api client
+        global api_client
+        api_client = SysdigApiClient(secure_url_authority, authentication_bearer, max_connections=args.workers, max_requests_per_second=args.max_requests_per_second)
 
         # Start performance counter
         pc_start = time.perf_counter()
 
+        # Sync the accept mirror
+        accept_mirror = open_accept_mirror(args.accepts_db, api_client, not args.no_sync)
+
         # Get all accepts
-        all_vuln_risk_accepts = _get_all_vuln_risk_accepts(secure_url_authority)
+        all_vuln_risk_accepts = _get_all_vuln_risk_accepts(accept_mirror)
         LOG.info(f"Found {len(all_vuln_risk_accepts)} vulnerability risk accepts.")
         
         # Delete accepts
         vuln_risk_accept_ids = _get_vuln_risk_accept_ids(all_vuln_risk_accepts)
-        _delete_vuln_risk_accepts(secure_url_authority, vuln_risk_accept_ids)
-        LOG.info(f"Deleted {len(all_vuln_risk_accepts)} vulnerability risk accepts.")
+        _delete_vuln_risk_accepts(vuln_risk_accept_ids, args.workers)
+        if accept_mirror != None:
+            accept_mirror.remove(vuln_risk_accept_ids)
 
         # End performance counter
         pc_end = time.perf_counter()
         LOG.info(f"Elapsed execution time: {pc_end - pc_start:0.4f} seconds")
 
         LOG.info('Request to delete vulnerability accepts complete.')
+        run_succeeded = True
 
     except Exception as e:
         LOG.critical(e)
         LOG.critical('Request to delete vulnerability accepts failed.')
         raise SystemExit()
+    finally:
+        if metrics_out != None and api_client != None:
+            api_client.save_metrics(metrics_out, metrics_format, { "run_duration_seconds": time.perf_counter() - run_start, "run_succeeded": int(run_succeeded) })
+            LOG.info(f"Saved the run metrics to {metrics_out}")
 
-def _delete_vuln_risk_accepts(secure_url_authority, vuln_risk_accept_ids):
+def _delete_vuln_risk_accepts(vuln_risk_accept_ids, workers=8):
 
     api_path = "api/scanning/riskmanager/v2/definitions"
 
-    for accept_def_id in vuln_risk_accept_ids:
-        api_url = f"https://{secure_url_authority}/{api_path}/{accept_def_id}"
-        LOG.info(f"Calling {api_url}")
-        _delete_data_from_http_request(api_url)
+    LOG.info(f"Deleting {len(vuln_risk_accept_ids)} vulnerability risk accepts with {workers} workers...")
+    counts = api_client.delete_all([ f"{api_path}/{accept_def_id}" for accept_def_id in vuln_risk_accept_ids ], workers)
+    LOG.info(f"Deleted {counts['deleted']} vulnerability risk accepts, {counts['not_found']} were already deleted.")
+
+    if counts["failed"] > 0:
+        raise Exception(f"Failed to delete {counts['failed']} vulnerability risk accepts")
 
     return
 
@@ -121,91 +195,20 @@ def _get_vuln_risk_accept_ids(all_vuln_risk_accepts):
 
     return vuln_risk_accept_ids
 
-def _get_all_vuln_risk_accepts(secure_url_authority):
-
-    limit=100
-    cursor=""
-    vuln_risk_accepts = []
+def _get_all_vuln_risk_accepts(accept_mirror=None):
 
-    while True:
+    if accept_mirror != None:
+        return accept_mirror.get_accepts()
 
-        api_path = "api/scanning/riskmanager/v2/definitions"
-        api_url = f"https://{secure_url_authority}/{api_path}?cursor={cursor}&limit={limit}"
-        response_data = _get_data_from_http_request(api_url)
-        json_response = json.loads(response_data)
+    vuln_risk_accepts = []
 
+    # The next page is downloaded while this one is added, using the
+    # largest page size the API accepts
+    api_path = "api/scanning/riskmanager/v2/definitions"
+    for json_response in api_client.paginate_prefetch(api_path):
         vuln_risk_accepts.extend(json_response['data'])
 
-        if json_response["page"]["next"] != '':
-            cursor = json_response["page"]["next"]
-        else:
-            break
-
-    #end while
-
     return vuln_risk_accepts
 
-def _delete_data_from_http_request(url):
-
-    response_data = None
-
-    try:
-
-        while True:
-            LOG.debug(f"Sending http request to: {url}")
-            response = http_client.request(method="DELETE", url=url, redirect=True)
-            response_data = response.data.decode()
-            LOG.debug(f"Response status: {response.status}")
-            if response.status == 200:
-                #LOG.debug(f"Response data: {response_data}")
-                break
-            elif response.status == 429:
-                LOG.debug(f"Response data: {response_data}")
-                LOG.info(f"Sleeping 60 seconds due to API throttling...")
-                time.sleep(60)
-                LOG.debug(f"Retrying request...")
-            else:
-                raise UnexpectedHTTPResponse(
-                    f"Unexpected HTTP response status: {response.status}"
-                )
-
-    except Exception as e:
-        LOG.critical(e)
-        LOG.critical(f"Error while requesting url: {url}")
-        raise SystemExit()
-
-    return response_data
-
-def _get_data_from_http_request(url):
-
-    response_data = None
-
-    try:
-
-        while True:
-            LOG.debug(f"Sending http request to: {url}")
-            response = http_client.request(method="GET", url=url, redirect=True)
-            response_data = response.data.decode()
-            LOG.debug(f"Response status: {response.status}")
-            if response.status == 200:
-                #LOG.debug(f"Response data: {response_data}")
-                break
-            elif response.status == 429:
-                LOG.debug(f"Response data: {response_data}")
-                LOG.info(f"Sleeping 60 seconds due to API throttling...")
-                time.sleep(60)
-                LOG.debug(f"Retrying request...")
-            else:
-                raise UnexpectedHTTPResponse(
-                    f"Unexpected HTTP response status: {response.status}"
-                )
-
-    except Exception as e:
-        LOG.critical(e)
-        LOG.critical(f"Error while requesting url: {url}")
-        raise SystemExit()
-
-    return response_data
-
 if __name__ == "__main__":
     sys.exit(main())
@@ -4,16 +4,29 @@
 
   Author: Kendall Adkins
   Date December 6th, 2023
+
+  Use --output_format ndjson to write one accept per line as each page is
+  received instead of holding every accept for an indented json list, the
+  memory used stays flat however many accepts there are. Add --gzip to
+  compress the output file while it is written.
+
+  Use --accepts_db to keep a local mirror of the accepts that is synced
+  incrementally, add --no_sync to read it without calling the API.
 """
 
 import logging
-import urllib3
 import sys
 import argparse
 from datetime import datetime
 import time
 import json
 import os
+import gzip
+
+# Shared Sysdig API client in the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from sysdig_api_client import SysdigApiClient
+from accept_mirror import open_accept_mirror
 
 # Setup logger
 LOG = logging.getLogger(__name__)
@@ -22,14 +35,9 @@ logging.basicConfig(
     format="%(asctime)s.%(msecs)03d %(levelname)s - %(funcName)s: %(message)s",
     datefmt="%Y-%m-%d %H:%M:%S",
 )
-logging.getLogger("urllib3").setLevel(logging.CRITICAL)
 
-# Setup http client
-http_client = urllib3.PoolManager()
-
-# Define custom exceptions
-class UnexpectedHTTPResponse(Exception):
-    """Used when recieving an unexpected HTTP response"""
+# Will be set by a passed arg
+api_client = None
 
 def _parse_args():
 
@@ -40,14 +48,14 @@ def _parse_args():
     )
     parser.add_argument(
         "--secure_url_authority",
-        required=True,
+        required=False,
         type=str,
         action="store",
         help="authority component of secure url",
     )
     parser.add_argument(
         "--api_token",
-        required=True,
+        required=False,
         type=str,
         action="store",
         help="Sysdig Secure API Token",
@@ -59,20 +67,74 @@ def _parse_args():
         action="store",
         help="File to save to.",
     )
+    parser.add_argument(
+        "--output_format",
+        required=False,
+        type=str,
+        choices=["json", "ndjson"],
+        default="json",
+        action="store",
+        help="Format of the output file, an indented json list or one json accept per line written as it is received (default: json)",
+    )
+    parser.add_argument(
+        "--gzip",
+        required=False,
+        action="store_true",
+        help="Gzip the output file",
+    )
+    parser.add_argument(
+        "--accepts_db",
+        required=False,
+        type=str,
+        action="store",
+        help="SQLite mirror of the accept definitions, it is synced with the API and the accepts are read from it",
+    )
+    parser.add_argument(
+        "--no_sync",
+        required=False,
+        action="store_true",
+        help="Read the accepts from --accepts_db without syncing it first",
+    )
+    parser.add_argument(
+        "--metrics_out",
+        required=False,
+        type=str,
+        action="store",
+        help="File to save the request metrics of each endpoint to",
+    )
+    parser.add_argument(
+        "--metrics_format",
+        required=False,
+        type=str,
+        choices=["json", "prometheus"],
+        default="json",
+        action="store",
+        help="Format of the metrics file, json or prometheus text (default: json)",
+    )
     return parser.parse_args()
 
 def main():
 
+    metrics_out = None
+    run_succeeded = False
+    run_start = time.perf_counter()
+
     try:
 
         LOG.info('Starting process to get vulnerability accepts...')
 
         # Parse the command line arguments
         args = _parse_args()
+        metrics_out = args.metrics_out
+        metrics_format = args.metrics_format
         secure_url_authority = args.secure_url_authority
         authentication_bearer = args.api_token
         output_file = args.output_file
 
+        # The API is only called when the accepts are not read from a mirror
+        if not args.no_sync and (secure_url_authority == None or authentication_bearer == None):
+            raise Exception(f"The --secure_url_authority and --api_token are required without --no_sync")
+
         # Validate the output file
         if output_file != None and os.path.isfile(output_file):
             raise Exception(f"The output file already exists: {output_file}")
@@ -81,60 +143,97 @@ def main():
         now = datetime.now()
         current_datetime = now.strftime("%Y-%m-%d %H:%M")
 
-        # Add the authentication header
-        http_client.headers["Authorization"] = f"Bearer {authentication_bearer}"
+        # Setup the api client
+        global api_client
+        api_client = SysdigApiClient(secure_url_authority, authentication_bearer)
 
         # Start performance counter
         pc_start = time.perf_counter()
 
-        # Get all accepts
-        all_vuln_risk_accepts = _get_all_vuln_risk_accepts(secure_url_authority)
-        LOG.info(f"Found {len(all_vuln_risk_accepts)} vulnerability risk accepts.")
-        
-        # Save accepts to a file
-        if output_file != None and len(all_vuln_risk_accepts) > 0:
-            _save_accepts(output_file, all_vuln_risk_accepts)
+        # Sync the accept mirror
+        accept_mirror = open_accept_mirror(args.accepts_db, api_client, not args.no_sync)
+
+        # Stream the accepts to a file as they are received
+        if output_file != None and args.output_format == "ndjson":
+            accepts_count = _stream_accepts(output_file, args.gzip, accept_mirror)
+            LOG.info(f"Found {accepts_count} vulnerability risk accepts.")
             LOG.info(f"Saved vulnerability accepts to: {output_file}")
 
+        else:
+
+            # Get all accepts
+            all_vuln_risk_accepts = _get_all_vuln_risk_accepts(accept_mirror)
+            LOG.info(f"Found {len(all_vuln_risk_accepts)} vulnerability risk accepts.")
+
+            # Save accepts to a file
+            if output_file != None and len(all_vuln_risk_accepts) > 0:
+                _save_accepts(output_file, all_vuln_risk_accepts, args.gzip)
+                LOG.info(f"Saved vulnerability accepts to: {output_file}")
+
+        #end if
+
         # End performance counter
         pc_end = time.perf_counter()
         LOG.info(f"Elapsed execution time: {pc_end - pc_start:0.4f} seconds")
 
         LOG.info('Get vulnerability accepts complete.')
+        run_succeeded = True
 
     except Exception as e:
         LOG.critical(e)
         LOG.critical('Get vulnerability accepts failed.')
         raise SystemExit()
+    finally:
+        if metrics_out != None and api_client != None:
+            api_client.save_metrics(metrics_out, metrics_format, { "run_duration_seconds": time.perf_counter() - run_start, "run_succeeded": int(run_succeeded) })
+            LOG.info(f"Saved the run metrics to {metrics_out}")
+
+def _open_output_file(output_file, compress=False):
+
+    if compress:
+        return gzip.open(output_file, "wt", compresslevel=6)
+
+    return open(output_file, "w")
 
-def _save_accepts(output_file, all_vuln_risk_accepts):
+def _save_accepts(output_file, all_vuln_risk_accepts, compress=False):
     
-    with open(output_file, "w") as outfile:
+    with _open_output_file(output_file, compress) as outfile:
         json.dump(all_vuln_risk_accepts, outfile, indent=2)
 
-def _get_all_vuln_risk_accepts(secure_url_authority):
+def _stream_accepts(output_file, compress=False, accept_mirror=None):
 
-    limit=100
-    cursor=""
-    vuln_risk_accepts = []
+    """
+    Writes each accept as a line of json as its page is received and
+    returns the number of accepts. The file is written under a temporary
+    name so a failed run does not leave a partial file behind.
+    """
 
-    while True:
+    accepts_count = 0
 
-        api_path = "api/scanning/riskmanager/v2/definitions"
-        api_url = f"https://{secure_url_authority}/{api_path}?cursor={cursor}&limit={limit}"
-        response_data = _get_data_from_http_request(api_url)
-        json_response = json.loads(response_data)
+    with _open_output_file(f"{output_file}.tmp", compress) as outfile:
+        for accept in _iter_vuln_risk_accepts(accept_mirror):
+            outfile.write(json.dumps(accept) + "\n")
+            accepts_count += 1
 
-        vuln_risk_accepts.extend(json_response['data'])
+    os.replace(f"{output_file}.tmp", output_file)
 
-        if json_response["page"]["next"] != '':
-            cursor = json_response["page"]["next"]
-        else:
-            break
+    return accepts_count
+
+def _get_all_vuln_risk_accepts(accept_mirror=None):
+
+    return list(_iter_vuln_risk_accepts(accept_mirror))
+
+def _iter_vuln_risk_accepts(accept_mirror=None):
 
-    #end while
+    if accept_mirror != None:
+        yield from accept_mirror.iter_accepts()
+        return
 
-    return vuln_risk_accepts
+    # The next page is downloaded while this one is handled, using the
+    # largest page size the API accepts
+    api_path = "api/scanning/riskmanager/v2/definitions"
+    for json_response in api_client.paginate_prefetch(api_path):
+        yield from json_response['data']
 
 #def _build_unique_runtime_image_list(runtime_scan_results_list):
 #
@@ -171,67 +270,5 @@ def _get_all_vuln_risk_accepts(secure_url_authority):
 #
 #    return runtime_scan_results_list
 
-def _delete_data_from_http_request(url):
-
-    response_data = None
-
-    try:
-
-        while True:
-            LOG.debug(f"Sending http request to: {url}")
-            response = http_client.request(method="DELETE", url=url, redirect=True)
-            response_data = response.data.decode()
-            LOG.debug(f"Response status: {response.status}")
-            if response.status == 200:
-                #LOG.debug(f"Response data: {response_data}")
-                break
-            elif response.status == 429:
-                LOG.debug(f"Response data: {response_data}")
-                LOG.info(f"Sleeping 60 seconds due to API throttling...")
-                time.sleep(60)
-                LOG.debug(f"Retrying request...")
-            else:
-                raise UnexpectedHTTPResponse(
-                    f"Unexpected HTTP response status: {response.status}"
-                )
-
-    except Exception as e:
-        LOG.critical(e)
-        LOG.critical(f"Error while requesting url: {url}")
-        raise SystemExit()
-
-    return response_data
-
-def _get_data_from_http_request(url):
-
-    response_data = None
-
-    try:
-
-        while True:
-            LOG.debug(f"Sending http request to: {url}")
-            response = http_client.request(method="GET", url=url, redirect=True)
-            response_data = response.data.decode()
-            LOG.debug(f"Response status: {response.status}")
-            if response.status == 200:
-                #LOG.debug(f"Response data: {response_data}")
-                break
-            elif response.status == 429:
-                LOG.debug(f"Response data: {response_data}")
-                LOG.info(f"Sleeping 60 seconds due to API throttling...")
-                time.sleep(60)
-                LOG.debug(f"Retrying request...")
-            else:
-                raise UnexpectedHTTPResponse(
-                    f"Unexpected HTTP response status: {response.status}"
-                )
-
-    except Exception as e:
-        LOG.critical(e)
-        LOG.critical(f"Error while requesting url: {url}")
-        raise SystemExit()
-
-    return response_data
-
 if __name__ == "__main__":
     sys.exit(main())